@@ -1,4 +1,7 @@
-from django.apps import AppConfig
+from django.apps import AppConfig, apps
+from django.core import checks
+from django.core.signals import setting_changed
+from django.db.models import signals
 from django.utils.text import capfirst
 from django.utils.translation import gettext_lazy as _
 
@@ -8,3 +11,33 @@ class SitesAppConfig(AppConfig):
 
     name = "feincms3_sites"
     verbose_name = capfirst(_("sites"))
+
+    def ready(self):
+        from feincms3_sites.cache import _invalidate_site_on_commit  # noqa: PLC0415
+        from feincms3_sites.checks import check_sites  # noqa: PLC0415
+        from feincms3_sites.middleware import (  # noqa: PLC0415
+            _clear_sites_snapshot,
+            _invalidate_sites_on_commit,
+            _remember_write,
+        )
+        from feincms3_sites.models import AbstractPage  # noqa: PLC0415
+        from feincms3_sites.utils import get_site_model  # noqa: PLC0415
+
+        checks.register(check_sites, checks.Tags.database)
+
+        site_model = get_site_model()
+        signals.post_save.connect(_invalidate_sites_on_commit, sender=site_model)
+        signals.post_delete.connect(_invalidate_sites_on_commit, sender=site_model)
+        # Read sites from the primary database after writes
+        signals.post_save.connect(_remember_write)
+        signals.post_delete.connect(_remember_write)
+        # SECURE_SSL_REDIRECT and FEINCMS3_SITES_* influence cached values
+        setting_changed.connect(_clear_sites_snapshot)
+
+        # Drop cached entries of sites when sites or their pages change
+        for model in [
+            site_model,
+            *(model for model in apps.get_models() if issubclass(model, AbstractPage)),
+        ]:
+            signals.post_save.connect(_invalidate_site_on_commit, sender=model)
+            signals.post_delete.connect(_invalidate_site_on_commit, sender=model)
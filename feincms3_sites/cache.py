@@ -0,0 +1,183 @@
+import hashlib
+import time
+from functools import partial
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.utils.cache import cc_delim_re, get_max_age, patch_vary_headers
+from django.utils.translation import get_language
+
+from feincms3_sites.middleware import current_site
+
+
+def _cache():
+    return caches[settings.FEINCMS3_SITES_CACHE_ALIAS]
+
+
+def _generation_key(site):
+    return "feincms3-sites:generation:%s" % getattr(site, "pk", site)
+
+
+def site_generation(site):
+    """
+    Return the current cache generation of the site (instance or primary key)
+
+    The generation is initialized with a time based value instead of zero so
+    that entries of earlier generations are not resurrected if the generation
+    itself has been evicted from the cache.
+    """
+    cache = _cache()
+    key = _generation_key(site)
+    if (generation := cache.get(key)) is None:
+        cache.add(key, time.time_ns(), timeout=None)
+        generation = cache.get(key)
+    return generation
+
+
+def invalidate_site(site):
+    """
+    Drop all cached entries of the site (instance or primary key)
+
+    Nothing is deleted, the generation of the site is incremented so that
+    the existing entries are not used anymore and expire eventually.
+    """
+    cache = _cache()
+    key = _generation_key(site)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, time.time_ns(), timeout=None)
+
+
+def site_cache_key(key, *, site=None):
+    """
+    Return ``key`` namespaced with the site and its cache generation
+
+    The current site is used if ``site`` (instance or primary key) isn't
+    given. Entries stored using namespaced keys are dropped all at once by
+    ``invalidate_site``, e.g.::
+
+        key = site_cache_key("navigation")
+        if (navigation := cache.get(key)) is None:
+            navigation = build_navigation()
+            cache.set(key, navigation)
+    """
+    if not (site := site or current_site()):
+        raise ImproperlyConfigured(
+            "Current site unknown. Pass a site or insert site_middleware."
+        )
+    return "feincms3-sites:{}:{}:{}".format(
+        getattr(site, "pk", site), site_generation(site), key
+    )
+
+
+def _invalidate_site_on_commit(sender, instance, **kwargs):
+    # AbstractPage instances have a site_id, site instances do not
+    if site := getattr(instance, "site_id", instance.pk):
+        transaction.on_commit(partial(invalidate_site, site), using=kwargs.get("using"))
+
+
+def _response_cache_key(request, site):
+    return site_cache_key(
+        "response:{}:{}:{}:{}".format(
+            settings.CACHE_MIDDLEWARE_KEY_PREFIX,
+            get_language(),
+            request.method,
+            hashlib.md5(
+                request.get_full_path().encode(), usedforsecurity=False
+            ).hexdigest(),
+        ),
+        site=site,
+    )
+
+
+def _vary_headers(response):
+    return {
+        header.lower()
+        for header in cc_delim_re.split(response.get("Vary", ""))
+        if header
+    }
+
+
+def _cache_timeout(request, response):
+    """
+    Return the timeout for caching the response or ``None`` if the response
+    shouldn't be cached at all.
+    """
+    if response.streaming or response.status_code != 200 or response.cookies:
+        return None
+
+    # Middleware further out may still add cookies to the response
+    session = getattr(request, "session", None)
+    if (session is not None and session.modified) or request.META.get(
+        "CSRF_COOKIE_NEEDS_UPDATE"
+    ):
+        return None
+
+    cache_control = response.get("Cache-Control", "").lower()
+    if any(
+        directive in cache_control for directive in ("private", "no-cache", "no-store")
+    ):
+        return None
+
+    # The language is a part of the cache key, everything else the response
+    # varies on isn't.
+    vary = _vary_headers(response)
+    vary.discard("accept-language")
+    if vary - {"cookie"} or ("cookie" in vary and request.COOKIES):
+        return None
+
+    timeout = get_max_age(response)
+    if timeout is None:
+        timeout = settings.CACHE_MIDDLEWARE_SECONDS
+    return timeout or None
+
+
+def site_cache_middleware(get_response):
+    """
+    Cache responses per site instead of per host
+
+    The cache key consists of the current site, the active language, the
+    path and the query string, therefore all hosts of a site share their
+    cache entries. Add the middleware after ``site_middleware`` and
+    ``default_language_middleware`` but before ``SessionMiddleware``,
+    ``CsrfViewMiddleware`` and ``AuthenticationMiddleware`` so that it sees
+    the ``Vary: Cookie`` header and the cookies they add. Use
+    ``invalidate_site`` to drop all cached responses of a site.
+
+    Responses varying on cookies are only cached for and served to requests
+    without cookies.
+    """
+
+    def middleware(request):
+        site = current_site()
+        if not site:
+            raise ImproperlyConfigured(
+                "Current site unknown. Insert site_middleware before site_cache_middleware."
+            )
+        if request.method not in {"GET", "HEAD"}:
+            return get_response(request)
+
+        cache = _cache()
+        key = _response_cache_key(request, site)
+        if (response := cache.get(key)) is not None and not (
+            request.COOKIES and "cookie" in _vary_headers(response)
+        ):
+            return response
+
+        response = get_response(request)
+        # SessionMiddleware adds the header itself, but only after this
+        # middleware has run if it has been inserted further out
+        session = getattr(request, "session", None)
+        if session is not None and session.accessed:
+            patch_vary_headers(response, ["Cookie"])
+        if timeout := _cache_timeout(request, response):
+            if hasattr(response, "render") and callable(response.render):
+                response.add_post_render_callback(lambda r: cache.set(key, r, timeout))
+            else:
+                cache.set(key, response, timeout)
+        return response
+
+    return middleware
@@ -0,0 +1,53 @@
+from django.conf import settings
+from django.core.checks import Error, Warning
+from django.db import DatabaseError, router
+
+from feincms3_sites.hosts import host_re_time, shadowed_sites
+from feincms3_sites.utils import get_site_model
+
+
+def check_sites(app_configs=None, *, databases=None, **kwargs):
+    """
+    Check the host regexes of all active sites for catastrophic backtracking
+    and for hosts which are shadowed by other sites
+
+    The check only runs when database checks are requested, e.g. using
+    ``./manage.py check --database default``.
+    """
+    site_model = get_site_model()
+    budget = settings.FEINCMS3_SITES_HOST_RE_BUDGET
+    errors = []
+    for alias in databases or ():
+        if not router.allow_migrate_model(alias, site_model):
+            continue
+        try:
+            sites = list(
+                site_model._default_manager.using(alias)
+                .active()
+                .only("pk", "is_default", "host", "host_re")
+            )
+        except DatabaseError:
+            # The table doesn't exist yet, e.g. when running migrate
+            continue
+
+        for site in sites:
+            if host_re_time(site.host_re, budget=budget) > budget:
+                errors.append(
+                    Error(
+                        f"The host regex {site.host_re!r} of the site {site}"
+                        f" takes more than {budget} seconds to match long hosts.",
+                        obj=site,
+                        id="feincms3_sites.E002",
+                        hint="Avoid nested quantifiers such as (a+)+.",
+                    )
+                )
+        errors.extend(
+            Warning(
+                f"The host of the site {site} resolves to {resolved or 'no site'}.",
+                obj=site,
+                id="feincms3_sites.W001",
+                hint="Make the host regexes more specific.",
+            )
+            for site, resolved in shadowed_sites(sites)
+        )
+    return errors
@@ -0,0 +1,10 @@
+from feincms3_sites.middleware import current_site
+
+
+def site(request):
+    """
+    Add the current site to the template context as ``current_site``
+
+    Uses the site resolved by ``site_middleware`` and never runs any queries.
+    """
+    return {"current_site": getattr(request, "site", None) or current_site()}
@@ -0,0 +1,253 @@
+import heapq
+import itertools
+import math
+import re
+from time import perf_counter
+
+
+# A token inside a group: an escaped character, a character class or any
+# other character except for parentheses and alternations.
+_GROUP_TOKEN = r"(?:\\.|\[(?:\\.|[^\]\\])*\]|[^()|\\\[])"
+# An escaped punctuation character or a character without special meaning
+_LITERAL_TOKEN = r"(?:\\[^A-Za-z0-9]|[^\\.^$*+?{}\[\]|()])"
+
+_INDEXABLE_HOST_RE = re.compile(
+    rf"""
+    (?P<start>
+        \^
+        (?P<prefix>\((?:\?:)?{_GROUP_TOKEN}*\\\.\)\?)?
+    )?
+    (?P<literal>{_LITERAL_TOKEN}+)
+    \$
+    """,
+    re.VERBOSE,
+)
+
+
+#: The maximum length of a fully qualified domain name
+MAX_HOST_LENGTH = 253
+
+# Probes are built by repeating these units. "!" is appended to each probe
+# so that the regex has to fail after trying all ways to match the units.
+_PROBE_UNITS = ("a", "a.", "a-", "0", "-")
+
+
+def analyze_host_re(host_re):
+    """
+    Return a ``(kind, value)`` tuple describing the hosts the regex may match
+
+    - ``("exact", host)`` for regexes of the form ``^example\\.com$`` (this
+      includes all managed regexes)
+    - ``("suffix", labels)`` for regexes of the form
+      ``^([a-z0-9-]+\\.)?example\\.com$`` or ``example\\.com$``. Matching
+      hosts always end with the labels, in reversed order.
+    - ``None`` for everything else
+
+    Values are lowercased. Regexes containing non-ASCII characters are never
+    analyzed since case-insensitive matching isn't equivalent to comparing
+    lowercased strings for those.
+    """
+    if not host_re.isascii() or not (match := _INDEXABLE_HOST_RE.fullmatch(host_re)):
+        return None
+
+    literal = re.sub(r"\\(.)", r"\1", match["literal"]).lower()
+    if match["start"] and not match["prefix"]:
+        return ("exact", literal)
+
+    labels = literal.split(".")
+    if not match["start"]:
+        # The first label may only be a partial match, e.g. example\.com$
+        # also matches myexample.com
+        labels = labels[1:]
+    return ("suffix", tuple(reversed(labels)))
+
+
+class HostIndex:
+    """
+    Index for finding the site matching a host without testing all regexes
+
+    ``resolution`` is a sequence of ``(compiled_host_re, site)`` tuples in
+    resolution order. Regexes recognized by ``analyze_host_re`` are indexed
+    in a dictionary of exact hosts and in a trie of reversed domain labels.
+    The index only narrows down the candidates, all candidates are verified
+    using their regex in resolution order. Therefore, the result is always
+    the same as when testing all regexes in order.
+
+    If ``sample_interval`` is set, every n-th lookup measures the time each
+    regex takes. Regexes which take longer than ``budget`` seconds in
+    ``strikes`` consecutive samples (the faster of two searches counts) are
+    quarantined: They are skipped from then on and
+    ``on_quarantine(site, elapsed)`` is called once.
+    """
+
+    def __init__(
+        self,
+        resolution,
+        *,
+        budget=None,
+        sample_interval=0,
+        strikes=3,
+        on_quarantine=None,
+    ):
+        self.resolution = resolution
+        self.budget = budget
+        self.sample_interval = sample_interval if budget is not None else 0
+        self.strikes = strikes
+        self.on_quarantine = on_quarantine
+        self._lookups = itertools.count(1)
+        # position -> number of consecutive slow samples
+        self._slow = {}
+        # Replaced instead of modified so that lookups can run concurrently
+        self.quarantined = frozenset()
+        self.exact = {}
+        # Trie nodes are (children, positions) tuples
+        self.trie = ({}, [])
+        unindexed = []
+        self.default = None
+
+        for position, (host_re, site) in enumerate(resolution):
+            if site.is_default:
+                self.default = site
+
+            analyzed = analyze_host_re(host_re.pattern)
+            if analyzed is None:
+                unindexed.append(position)
+            elif analyzed[0] == "exact":
+                self.exact.setdefault(analyzed[1], position)
+            else:
+                node = self.trie
+                for label in analyzed[1]:
+                    node = node[0].setdefault(label, ({}, []))
+                node[1].append(position)
+
+        self.unindexed = tuple(unindexed)
+
+    def candidates(self, host):
+        """
+        Return the positions of all sites which may match the host, in
+        resolution order
+        """
+        if not host.isascii() or "\n" in host:
+            # $ also matches before a trailing newline
+            return range(len(self.resolution))
+
+        host = host.lower()
+        positions = []
+        if (position := self.exact.get(host)) is not None:
+            positions.append(position)
+        node = self.trie
+        positions.extend(node[1])
+        for label in reversed(host.split(".")):
+            if (node := node[0].get(label)) is None:
+                break
+            positions.extend(node[1])
+        return heapq.merge(sorted(positions), self.unindexed)
+
+    def match(self, host):
+        """
+        Return the first site matching the host, or ``None``
+        """
+        if self.sample_interval and not next(self._lookups) % self.sample_interval:
+            return self._timed_match(host)
+
+        quarantined = self.quarantined
+        for position in self.candidates(host):
+            if quarantined and position in quarantined:
+                continue
+            host_re, site = self.resolution[position]
+            if host_re.search(host):
+                return site
+        return None
+
+    def site_for_host(self, host):
+        """
+        Return the first site matching the host, or the last default site
+        """
+        if (site := self.match(host)) is not None:
+            return site
+        return self.default
+
+    def _timed_match(self, host):
+        for position in self.candidates(host):
+            if position in self.quarantined:
+                continue
+            host_re, site = self.resolution[position]
+            start = perf_counter()
+            match = host_re.search(host)
+            elapsed = perf_counter() - start
+            if elapsed > self.budget:
+                # Search again so that a thread switch or the garbage
+                # collector doesn't count as a strike
+                start = perf_counter()
+                host_re.search(host)
+                elapsed = min(elapsed, perf_counter() - start)
+            self._record(position, elapsed)
+            if match:
+                return site
+        return None
+
+    def _record(self, position, elapsed):
+        if elapsed <= self.budget:
+            self._slow.pop(position, None)
+            return
+
+        self._slow[position] = slow = self._slow.get(position, 0) + 1
+        if slow >= self.strikes and position not in self.quarantined:
+            self.quarantined |= {position}
+            if self.on_quarantine:
+                self.on_quarantine(self.resolution[position][1], elapsed)
+
+
+def host_re_time(host_re, *, budget, max_length=MAX_HOST_LENGTH, repeats=3):
+    """
+    Return the longest time the regex needs for searching probe hosts
+
+    Probes of increasing length are tested one after the other. Patterns
+    with catastrophic backtracking take exponentially longer with each
+    additional character, therefore the measurement stops as soon as a
+    probe takes longer than ``budget`` seconds instead of running (almost)
+    forever. Probes exceeding the budget are searched up to ``repeats``
+    times and the fastest search counts so that a single search delayed by
+    a thread switch or the garbage collector doesn't fail harmless regexes.
+    """
+    regex = re.compile(host_re, re.IGNORECASE)
+    worst = 0.0
+    for length in range(1, max_length + 1):
+        for unit in _PROBE_UNITS:
+            probe = (unit * length)[:length] + "!"
+            elapsed = math.inf
+            for _ in range(repeats):
+                start = perf_counter()
+                regex.search(probe)
+                elapsed = min(elapsed, perf_counter() - start)
+                if elapsed <= budget:
+                    break
+            else:
+                return elapsed
+            worst = max(worst, elapsed)
+    return worst
+
+
+def shadowed_sites(sites, *, only=None):
+    """
+    Yield ``(site, resolved)`` tuples for all sites whose host resolves to
+    another site (or to no site at all)
+
+    ``sites`` are site instances or records with ``pk``, ``host``,
+    ``host_re`` and ``is_default`` attributes, sites without primary key
+    are resolved last. Pass ``only`` to restrict the result to conflicts
+    involving a single site.
+    """
+    sites = sorted(
+        sites,
+        key=lambda site: (-site.is_default, math.inf if site.pk is None else site.pk),
+    )
+    index = HostIndex(
+        tuple((re.compile(site.host_re, re.IGNORECASE), site) for site in sites)
+    )
+    for site in sites:
+        resolved = index.site_for_host(site.host)
+        if resolved is site:
+            continue
+        if only is None or only is site or only is resolved:
+            yield site, resolved
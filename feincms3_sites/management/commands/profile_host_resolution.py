@@ -0,0 +1,123 @@
+import re
+import sys
+from collections import Counter, defaultdict
+from contextlib import ExitStack
+from time import perf_counter
+
+from django.core.management.base import BaseCommand
+
+from feincms3_sites.middleware import _load_snapshot, _normalize_host
+
+
+class Command(BaseCommand):
+    help = (
+        "Resolves hosts from access logs or lists of hosts and reports throughput,"
+        " hits per site, hosts falling back to the default site and hosts"
+        " matching several sites."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "files",
+            nargs="*",
+            default=["-"],
+            help="Files to read, '-' reads from standard input (the default).",
+        )
+        parser.add_argument(
+            "--regex",
+            help=(
+                "Regular expression with a named group 'host' used to extract hosts"
+                " from lines. By default, the first whitespace-separated field of"
+                " each line is used."
+            ),
+        )
+        parser.add_argument(
+            "--top",
+            type=int,
+            default=10,
+            help="Number of entries shown per section (default: 10).",
+        )
+
+    def _lines(self, files):
+        with ExitStack() as stack:
+            for name in files:
+                if name == "-":
+                    yield from sys.stdin
+                else:
+                    yield from stack.enter_context(
+                        open(name, encoding="utf-8", errors="replace")
+                    )
+
+    def _hosts(self, files, regex):
+        if regex:
+            regex = re.compile(regex)
+        for line in self._lines(files):
+            if regex:
+                host = match["host"] if (match := regex.search(line)) else None
+            else:
+                host = fields[0] if (fields := line.split(None, 1)) else None
+            if host:
+                yield _normalize_host(host)
+
+    def handle(self, *, files, regex, top, **options):
+        snapshot = _load_snapshot()
+
+        hosts = Counter()
+        hits = Counter()
+        elapsed = 0
+        # Resolve each line separately to measure the real throughput
+        for host in self._hosts(files, regex):
+            start = perf_counter()
+            site = snapshot.site_for_host(host)
+            elapsed += perf_counter() - start
+            hosts[host] += 1
+            hits[site] += 1
+
+        total = sum(hosts.values())
+        self.stdout.write(
+            "Resolved %d hosts (%d distinct) in %.3fs (%d hosts/s)"
+            % (total, len(hosts), elapsed, total / elapsed if elapsed else 0)
+        )
+
+        # Test all regexes against all distinct hosts
+        fallbacks = Counter()
+        overlaps = {}
+        regex_times = defaultdict(float)
+        for host, count in hosts.items():
+            matching = []
+            for host_re, site in snapshot.hosts.resolution:
+                start = perf_counter()
+                if host_re.search(host):
+                    matching.append(site)
+                regex_times[site] += perf_counter() - start
+            if not matching:
+                fallbacks[host] = count
+            elif len(matching) > 1:
+                overlaps[host] = matching
+
+        def site_label(site):
+            return f"{site.host} ({site.pk})" if site else "(no site)"
+
+        self.stdout.write("\nHits per site:")
+        for site, count in hits.most_common(top):
+            self.stdout.write(f"  {count:>10}  {site_label(site)}")
+
+        self.stdout.write("\nHosts falling back to the default site or without site:")
+        for host, count in fallbacks.most_common(top):
+            self.stdout.write(f"  {count:>10}  {host}")
+
+        self.stdout.write("\nHosts matching several sites:")
+        for host, sites in sorted(overlaps.items())[:top]:
+            self.stdout.write(
+                "  {}: {}".format(host, ", ".join(site_label(site) for site in sites))
+            )
+
+        self.stdout.write(
+            "\nSlowest host regexes (total time for %d distinct hosts):" % len(hosts)
+        )
+        for site, seconds in sorted(
+            regex_times.items(), key=lambda row: row[1], reverse=True
+        )[:top]:
+            self.stdout.write(
+                f"  {seconds:>10.6f}s  {site_label(site)}  {site.host_re}"
+            )
@@ -0,0 +1,178 @@
+import gc
+import re
+import tracemalloc
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.core.signals import request_finished
+from django.db import transaction
+from django.http import HttpResponse
+from django.test import RequestFactory
+from feincms3 import applications
+
+from feincms3_sites.middleware import (
+    default_language_middleware,
+    invalidate_sites,
+    reverse_site_app,
+    site_middleware,
+)
+from feincms3_sites.utils import get_site_model
+
+
+def _kib(size):
+    return f"{size / 1024:.1f} KiB"
+
+
+class Command(BaseCommand):
+    help = (
+        "Simulates requests to synthetic sites using tracemalloc and reports"
+        " the memory used per site and the top allocation sites. All sites"
+        " and pages are created inside a transaction which is rolled back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sites",
+            type=int,
+            default=100,
+            help="Number of synthetic sites (default: 100).",
+        )
+        parser.add_argument(
+            "--requests",
+            type=int,
+            default=10,
+            help="Number of requests per site after warming up (default: 10).",
+        )
+        parser.add_argument(
+            "--app",
+            help=(
+                "Create an application page per site and reverse a view of it"
+                " using reverse_site_app in each request, e.g. 'blog:article-list'."
+                " The page model has to use feincms3's LanguageMixin and"
+                " PageTypeMixin."
+            ),
+        )
+        parser.add_argument(
+            "--top",
+            type=int,
+            default=10,
+            help="Number of allocation sites shown (default: 10).",
+        )
+        parser.add_argument(
+            "--max-per-site",
+            type=int,
+            help="Fail if a site uses more than this many bytes.",
+        )
+
+    def handle(self, *, sites, requests, app, top, max_per_site, **options):
+        page_type, _sep, viewname = (app or "").partition(":")
+        if app and not viewname:
+            raise CommandError("--app has to be of the form 'page_type:viewname'.")
+
+        with transaction.atomic():
+            hosts = self._create_sites(sites, page_type=page_type)
+            try:
+                self._profile(
+                    hosts,
+                    requests=requests,
+                    page_type=page_type,
+                    viewname=viewname,
+                    top=top,
+                    max_per_site=max_per_site,
+                )
+            finally:
+                transaction.set_rollback(True)
+                invalidate_sites()
+
+    def _create_sites(self, count, *, page_type):
+        site_model = get_site_model()
+        language_code = settings.LANGUAGES[0][0]
+        hosts = [f"site-{index}.profile-memory.invalid" for index in range(count)]
+        # bulk_create skips the validation of host regexes against all other
+        # sites which is quadratic
+        site_model._default_manager.bulk_create(
+            site_model(
+                host=host,
+                host_re=r"^%s$" % re.escape(host),
+                default_language=language_code,
+            )
+            for host in hosts
+        )
+        if page_type:
+            for index, site in enumerate(
+                site_model._default_manager.filter(host__in=hosts)
+            ):
+                applications._APPS_MODEL._default_manager.create(
+                    title=page_type,
+                    slug=f"{page_type}-{index}",
+                    static_path=True,
+                    path=f"/{page_type}-{index}/",
+                    language_code=language_code,
+                    is_active=True,
+                    page_type=page_type,
+                    site=site,
+                )
+        invalidate_sites()
+        return hosts
+
+    def _profile(self, hosts, *, requests, page_type, viewname, top, max_per_site):
+        def view(request):
+            if viewname:
+                reverse_site_app(page_type, viewname, site=request.site)
+            return HttpResponse()
+
+        handler = site_middleware(default_language_middleware(view))
+        factory = RequestFactory()
+
+        def simulate():
+            for host in hosts:
+                handler(factory.get("/", HTTP_HOST=host))
+                # Drop per-request caches like Django's request handler
+                request_finished.send(sender=self.__class__)
+
+        tracemalloc.start()
+        try:
+            gc.collect()
+            baseline = tracemalloc.take_snapshot()
+            simulate()
+            gc.collect()
+            warm = tracemalloc.take_snapshot()
+            for _ in range(requests):
+                simulate()
+            gc.collect()
+            steady = tracemalloc.take_snapshot()
+        finally:
+            tracemalloc.stop()
+
+        filters = [
+            tracemalloc.Filter(inclusive=False, filename_pattern=tracemalloc.__file__)
+        ]
+        baseline = baseline.filter_traces(filters)
+        warm = warm.filter_traces(filters)
+        steady = steady.filter_traces(filters)
+
+        total = sum(stat.size_diff for stat in warm.compare_to(baseline, "filename"))
+        growth = sum(stat.size_diff for stat in steady.compare_to(warm, "filename"))
+        per_site = total / len(hosts) if hosts else 0
+
+        self.stdout.write(f"Sites: {len(hosts)}, requests per site: {requests}")
+        self.stdout.write(
+            f"Memory after warming up: {_kib(total)} ({_kib(per_site)} per site)"
+        )
+        self.stdout.write(
+            f"Growth during {requests * len(hosts)} requests: {_kib(growth)}"
+        )
+
+        self.stdout.write("\nTop allocation sites:")
+        for stat in steady.compare_to(baseline, "lineno")[:top]:
+            frame = stat.traceback[0]
+            self.stdout.write(
+                f"  {_kib(stat.size_diff):>12}  {stat.count_diff:>8} blocks"
+                f"  {frame.filename}:{frame.lineno}"
+            )
+
+        if max_per_site is not None and per_site > max_per_site:
+            raise CommandError(
+                f"Sites use {per_site:.0f} bytes each, more than the maximum of"
+                f" {max_per_site} bytes."
+            )
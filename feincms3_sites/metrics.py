@@ -0,0 +1,129 @@
+import bisect
+import json
+import logging
+import math
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from feincms3_sites.middleware import current_site
+from feincms3_sites.utils import import_callable
+
+
+logger = logging.getLogger(__name__)
+
+#: Upper bounds of the latency histogram buckets in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, math.inf)
+
+
+class SiteMetrics:
+    __slots__ = ("latency", "latency_sum", "requests", "status_codes")
+
+    def __init__(self):
+        self.requests = 0
+        self.status_codes = Counter()
+        self.latency = [0] * len(LATENCY_BUCKETS)
+        self.latency_sum = 0.0
+
+    def as_dict(self):
+        return {
+            "requests": self.requests,
+            "status_codes": dict(self.status_codes),
+            "latency_sum": self.latency_sum,
+            "latency_buckets": dict(zip(LATENCY_BUCKETS, self.latency)),
+        }
+
+
+class MetricsCollector:
+    """
+    Aggregate request metrics per site in memory
+
+    The metrics are passed to the ``FEINCMS3_SITES_METRICS_SINK`` callable
+    (or dotted path) every ``FEINCMS3_SITES_METRICS_INTERVAL`` seconds. The
+    flush happens during the request which happens to record the first
+    measurement after the interval has passed, no background thread is
+    started.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self._started = time.monotonic()
+
+    def record(self, site_pk, status_code, elapsed):
+        with self._lock:
+            if (metrics := self._metrics.get(site_pk)) is None:
+                metrics = self._metrics[site_pk] = SiteMetrics()
+            metrics.requests += 1
+            metrics.status_codes[status_code] += 1
+            metrics.latency[bisect.bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+            metrics.latency_sum += elapsed
+        if time.monotonic() - self._started >= settings.FEINCMS3_SITES_METRICS_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        """
+        Pass the metrics collected since the last flush to the sink and
+        start over
+        """
+        with self._lock:
+            metrics, self._metrics = self._metrics, {}
+            started, self._started = self._started, time.monotonic()
+            duration = self._started - started
+        if metrics:
+            # The sink runs during a request which shouldn't fail because
+            # of it
+            try:
+                import_callable(settings.FEINCMS3_SITES_METRICS_SINK)(
+                    {
+                        pk: site_metrics.as_dict()
+                        for pk, site_metrics in metrics.items()
+                    },
+                    duration=duration,
+                )
+            except Exception:
+                logger.exception("Passing the metrics of sites to the sink failed.")
+
+
+def log_sink(metrics, *, duration):
+    """
+    Log the metrics of each site as a line of JSON
+
+    Use the ``LOGGING`` setting to write the lines to a file.
+    """
+    for pk, site_metrics in metrics.items():
+        logger.info(
+            json.dumps(
+                {"site": pk, "duration": duration, **site_metrics},
+                default=str,
+            )
+        )
+
+
+collector = MetricsCollector()
+
+
+def site_metrics_middleware(get_response):
+    """
+    Record the number of requests, status codes and latencies per site
+
+    Add the middleware directly after ``site_middleware`` so that the
+    latency includes the time spent in all following middleware.
+    """
+
+    def middleware(request):
+        site = current_site()
+        if not site:
+            raise ImproperlyConfigured(
+                "Current site unknown. Insert site_middleware before site_metrics_middleware."
+            )
+
+        start = time.perf_counter()
+        response = get_response(request)
+        collector.record(site.pk, response.status_code, time.perf_counter() - start)
+        return response
+
+    return middleware
@@ -1,15 +1,21 @@
 import contextvars
+import logging
+import math
 import re
-import sys
+import time
 from contextlib import contextmanager
+from types import MappingProxyType
 from urllib.parse import urljoin
 
 from asgiref.local import Local
 from django.conf import settings
 from django.conf.urls.i18n import is_language_prefix_patterns_used
-from django.core.exceptions import ImproperlyConfigured
+from django.core.cache import caches
+from django.core.exceptions import DisallowedHost, ImproperlyConfigured
 from django.core.signals import request_finished
+from django.db import router, transaction
 from django.http import Http404, HttpResponsePermanentRedirect, HttpResponseRedirect
+from django.http.request import split_domain_port
 from django.urls import get_script_prefix, is_valid_path
 from django.utils.cache import patch_vary_headers
 from django.utils.encoding import iri_to_uri
@@ -20,14 +26,23 @@ from django.utils.translation import (
     get_language_from_request,
 )
 from feincms3 import applications
-from feincms3.applications import _del_apps_urlconf_cache, apps_urlconf, reverse_app
+from feincms3.applications import _del_apps_urlconf_cache, reverse_app
+
+from feincms3_sites.hosts import HostIndex
+from feincms3_sites.signals import host_re_quarantined
+from feincms3_sites.urlconfs import _urlconf_in_use, site_apps_urlconf
 
 # must use this import, do not change
 from feincms3_sites.utils import get_site_model
 
 
+logger = logging.getLogger(__name__)
+
 _current_site = contextvars.ContextVar("current_site", default=None)
 _sites = contextvars.ContextVar("sites", default=None)
+# Monotonic time of the last save or deletion of model instances, reset for
+# each request
+_wrote = contextvars.ContextVar("wrote", default=None)
 
 
 def _normalize_host(host):
@@ -36,6 +51,8 @@ def _normalize_host(host):
     for HTTP and HTTPS respectively and are often omitted in site configurations.
     Also normalize an optional trailing dot.
     """
+    if ":" not in host and not host.endswith("."):
+        return host
     if host.startswith("["):
         # IPv6 address in brackets, e.g. [::1]:80
         if host.endswith((":80", ":443")):
@@ -59,9 +76,16 @@ def site_for_host(host, *, sites=None):
     host configurations.
     """
 
-    host = _normalize_host(host)
+    return _site_for_normalized_host(_normalize_host(host), sites=sites)
+
+
+def _site_for_normalized_host(host, *, sites=None):
     if sites is None:
-        sites = get_site_model()._default_manager.active()
+        sites = (
+            get_site_model()
+            ._default_manager.active()
+            .only(*SiteRecord.fields, *settings.FEINCMS3_SITES_RESOLUTION_FIELDS)
+        )
     default = None
     for site in sorted(sites, key=lambda site: (-site.is_default, site.pk)):
         if re.search(site.host_re, host, re.IGNORECASE):
@@ -71,21 +95,304 @@ def site_for_host(host, *, sites=None):
     return default
 
 
+class SiteRecord:
+    """
+    Lightweight read-only representation of an active site
+
+    Records only contain the fields needed for resolving sites and building
+    absolute URLs plus the fields listed in the
+    ``FEINCMS3_SITES_RESOLUTION_FIELDS`` setting. The site model instance is
+    only created when ``instance`` is accessed, without running a query. All
+    other fields of the instance are deferred and loaded from the database
+    when accessed. Records are shared by all threads of the process,
+    therefore each access returns a new instance.
+    """
+
+    fields = (
+        "pk",
+        "is_default",
+        "host",
+        "host_re",
+        "default_language",
+        "language_codes",
+    )
+    __slots__ = (
+        *fields,
+        "_model",
+        "_db",
+        "_extra",
+        "_feincms3_sites_base_url",
+    )
+
+    def __init__(self, model, db, values, *, extra_fields=()):
+        for field, value in zip(self.fields, values):
+            object.__setattr__(self, field, value)
+        self._model = model
+        self._db = db
+        self._extra = dict(zip(extra_fields, values[len(self.fields) :]))
+
+    def __getattr__(self, name):
+        # Only called if the attribute hasn't been found, _extra always exists
+        try:
+            return self._extra[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def __setattr__(self, name, value):
+        # Only allow setting the private attributes used for memoization
+        if not name.startswith("_"):
+            raise AttributeError("Site records are read-only.")
+        object.__setattr__(self, name, value)
+
+    def __repr__(self):
+        return f"<SiteRecord: {self.host} ({self.pk})>"
+
+    def __str__(self):
+        return self.host
+
+    @property
+    def instance(self):
+        opts = self._model._meta
+        attnames = [
+            opts.pk.attname if field == "pk" else opts.get_field(field).attname
+            for field in (*self.fields, *self._extra)
+        ]
+        values = [getattr(self, field) for field in self.fields]
+        return self._model.from_db(self._db, attnames, [*values, *self._extra.values()])
+
+    def get_host(self):
+        return self.instance.get_host()
+
+    def get_absolute_url(self):
+        return self.instance.get_absolute_url()
+
+
+def _read_database():
+    """
+    Return the database alias for reading sites and applications or ``None``
+
+    ``FEINCMS3_SITES_READ_DATABASE`` isn't used after writes so that sites
+    and pages changed in the same request are visible immediately. Outside of
+    requests (e.g. in management commands and task queues) the read database
+    is used again ``FEINCMS3_SITES_READ_DATABASE_DELAY`` seconds after the
+    last write in the same context.
+    """
+    if (wrote := _wrote.get()) is not None and (
+        time.monotonic() - wrote < settings.FEINCMS3_SITES_READ_DATABASE_DELAY
+    ):
+        return None
+    return settings.FEINCMS3_SITES_READ_DATABASE
+
+
+def _remember_write(**kwargs):
+    _wrote.set(time.monotonic())
+
+
+def _site_records(*, primary=False):
+    queryset = (
+        get_site_model()
+        ._default_manager.using(None if primary else _read_database())
+        .active()
+    )
+    # Instances are saved to and refreshed from the primary database
+    db = router.db_for_write(queryset.model) if queryset._db else queryset.db
+    extra_fields = tuple(settings.FEINCMS3_SITES_RESOLUTION_FIELDS)
+    return [
+        SiteRecord(queryset.model, db, values, extra_fields=extra_fields)
+        for values in queryset.values_list(*SiteRecord.fields, *extra_fields)
+    ]
+
+
+def _quarantine_host_re(site, elapsed):
+    logger.error(
+        "Skipping the slow host regex %r of the site %s (%s) when resolving"
+        " hosts, matching took %.4f seconds.",
+        site.host_re,
+        site.host,
+        site.pk,
+        elapsed,
+    )
+    host_re_quarantined.send(sender=get_site_model(), site=site, elapsed=elapsed)
+
+
+class _SitesSnapshot:
+    """
+    State derived from all active sites, shared by all threads of the process
+
+    Snapshots are never modified after construction (except for the redirect
+    table which is filled by ``redirect_to_site_middleware`` and the time of
+    the last version check), changes replace the current snapshot instead.
+    """
+
+    def __init__(self, sites, *, version):
+        self.sites = MappingProxyType({site.pk: site for site in sites})
+        # Sites in resolution order with their compiled host regexes
+        self.hosts = HostIndex(
+            tuple(
+                (re.compile(site.host_re, re.IGNORECASE), site)
+                for site in sorted(
+                    self.sites.values(), key=lambda site: (-site.is_default, site.pk)
+                )
+            ),
+            budget=settings.FEINCMS3_SITES_HOST_RE_BUDGET,
+            sample_interval=settings.FEINCMS3_SITES_HOST_RE_SAMPLE_INTERVAL,
+            strikes=settings.FEINCMS3_SITES_HOST_RE_STRIKES,
+            on_quarantine=_quarantine_host_re,
+        )
+        self.version = version
+        # Monotonic time when the version has been compared the last time
+        self.checked = time.monotonic()
+        timeout = settings.FEINCMS3_SITES_SNAPSHOT_TIMEOUT
+        self.expires = math.inf if timeout is None else self.checked + timeout
+        # (host, is_secure) -> redirect location prefix
+        self.redirects = {}
+
+    def site_for_host(self, host):
+        return self.hosts.site_for_host(host)
+
+
+class _SitesState:
+    snapshot = None
+    # Version of the last snapshot, unknown until the first one is loaded
+    version = object()
+
+
+_sites_state = _SitesState()
+# Bounds memory usage, hosts falling back to the default site are arbitrary
+_REDIRECTS_MAX_SIZE = 1000
+_SITES_VERSION_KEY = "feincms3-sites:sites-version"
+
+
+def _sites_cache():
+    return caches[settings.FEINCMS3_SITES_CACHE_ALIAS]
+
+
+def _load_snapshot(*, check_interval=0):
+    snapshot = _sites_state.snapshot
+    now = time.monotonic()
+    if (
+        snapshot is not None
+        and now - snapshot.checked < check_interval
+        and snapshot.expires > now
+    ):
+        return snapshot
+    version = _sites_cache().get(_SITES_VERSION_KEY)
+    if snapshot is not None and snapshot.version == version and snapshot.expires > now:
+        snapshot.checked = now
+    else:
+        # The read database may still lag behind when sites have just been
+        # changed, the snapshot would be kept until it expires.
+        snapshot = _sites_state.snapshot = _SitesSnapshot(
+            _site_records(primary=version != _sites_state.version),
+            version=version,
+        )
+        _sites_state.version = version
+    return snapshot
+
+
+def load_sites():
+    """
+    Return a read-only mapping of all active sites keyed by their primary key
+
+    The values are ``SiteRecord`` instances.
+
+    The mapping is loaded once and shared by all threads of the process and
+    all requests until a site is saved or deleted or until
+    ``FEINCMS3_SITES_SNAPSHOT_TIMEOUT`` seconds have passed. Changes are
+    propagated to other processes through a version stored in the
+    ``FEINCMS3_SITES_CACHE_ALIAS`` cache if the cache is shared between
+    processes. The version is fetched at most every
+    ``FEINCMS3_SITES_VERSION_CHECK_INTERVAL`` seconds outside of requests.
+    Batch jobs may pin a snapshot using ``with set_sites(load_sites()): ...``
+    to avoid even that.
+    """
+    return _load_snapshot(
+        check_interval=settings.FEINCMS3_SITES_VERSION_CHECK_INTERVAL
+    ).sites
+
+
+def _clear_sites_snapshot(**kwargs):
+    _sites_state.snapshot = None
+
+
+def invalidate_sites(**kwargs):
+    """
+    Drop the snapshot of sites used by ``load_sites`` in all processes
+
+    Called automatically when sites are saved or deleted. Has to be called
+    manually after bulk updates which do not send signals.
+    """
+    _clear_sites_snapshot()
+    _sites_cache().set(_SITES_VERSION_KEY, time.time_ns(), timeout=None)
+
+
+def _invalidate_sites_on_commit(sender, **kwargs):
+    # Invalidate immediately for the current thread and again after the
+    # commit so that no other thread keeps a snapshot of uncommitted data.
+    invalidate_sites()
+    transaction.on_commit(invalidate_sites, using=kwargs.get("using"))
+
+
 def _get_sites():
-    return _sites.get() or {
-        site.pk: site for site in get_site_model()._default_manager.active()
-    }
+    return _sites.get() or load_sites()
+
+
+def _site_base_url(site):
+    """
+    Return a ``(base_url, origin)`` tuple for the site instance
+
+    ``base_url`` is the return value of ``site.get_absolute_url()`` and
+    ``origin`` its scheme and host part, already converted using
+    ``iri_to_uri``. The tuple is memoized on the instance because
+    ``get_host`` may be a user-supplied callable doing real work.
+    """
+    try:
+        return site._feincms3_sites_base_url
+    except AttributeError:
+        base_url = site.get_absolute_url()
+        site._feincms3_sites_base_url = (
+            base_url,
+            iri_to_uri(urljoin(base_url, "/")[:-1]),
+        )
+        return site._feincms3_sites_base_url
 
 
 def build_absolute_uri(url, *, site=None):
+    """
+    Return the URL prefixed with the scheme and host of the site (instance,
+    record or primary key) or the current site
+
+    Outside of requests the snapshot returned by ``load_sites`` is used. Loops
+    building many URLs may pin it using ``with set_sites(load_sites()): ...``.
+    """
     site = site or current_site()
     if hasattr(site, "pk"):
         site = site.pk
     if site and (obj := _get_sites().get(site)):
-        return iri_to_uri(urljoin(obj.get_absolute_url(), url))
+        base_url, origin = _site_base_url(obj)
+        if url.startswith("/") and not url.startswith("//"):
+            # Fast path for absolute paths, iri_to_uri may be applied to the
+            # parts separately.
+            return origin + iri_to_uri(url)
+        return iri_to_uri(urljoin(base_url, url))
     return url
 
 
+def build_absolute_uris(objects):
+    """
+    Yield absolute URLs for all objects
+
+    The objects are expected to have a ``site_id`` attribute and a
+    ``get_absolute_url`` method. Sites are only resolved once for all objects,
+    also outside of ``set_sites`` blocks.
+    """
+    sites = _get_sites()
+    for obj in objects:
+        with set_sites(sites):
+            url = build_absolute_uri(obj.get_absolute_url(), site=obj.site_id)
+        yield url
+
+
 def _del_reverse_site_cache(**kwargs):
     _reverse_site_cache.cache = {}
 
@@ -99,23 +406,30 @@ def reverse_site_app(*args, site, **kwargs):
         _reverse_site_cache.cache = {}
     key = site.pk if hasattr(site, "pk") else site
 
-    if (urlconf := _reverse_site_cache.cache.get(key)) and urlconf in sys.modules:
+    def generate():
+        queryset = applications._APPS_MODEL._default_manager.active(site=site)
+        if queryset._db is None:
+            queryset = queryset.using(_read_database())
+        _reverse_site_cache.cache[key] = site_apps_urlconf(apps=queryset.applications())
+        return _reverse_site_cache.cache[key]
+
+    with _urlconf_in_use(
+        _reverse_site_cache.cache.get(key) or generate(), generate
+    ) as urlconf:
         kwargs["urlconf"] = urlconf
-    else:
-        apps = applications._APPS_MODEL._default_manager.active(
-            site=site
-        ).applications()
-        kwargs["urlconf"] = _reverse_site_cache.cache[key] = apps_urlconf(apps=apps)
-    return build_absolute_uri(reverse_app(*args, **kwargs), site=site)
+        url = reverse_app(*args, **kwargs)
+    return build_absolute_uri(url, site=site)
 
 
 @contextmanager
 def set_current_site(site):
     token = _current_site.set(site)
     _del_apps_urlconf_cache()
-    yield
-    _current_site.reset(token)
-    _del_apps_urlconf_cache()
+    try:
+        yield
+    finally:
+        _current_site.reset(token)
+        _del_apps_urlconf_cache()
 
 
 def current_site():
@@ -125,20 +439,126 @@ def current_site():
 @contextmanager
 def set_sites(sites):
     token = _sites.set(sites)
-    yield
-    _sites.reset(token)
+    try:
+        yield
+    finally:
+        _sites.reset(token)
+
+
+def _redirects():
+    # Only use redirects determined using the current snapshot
+    if (snapshot := _sites_state.snapshot) and snapshot.sites is _sites.get():
+        return snapshot.redirects
+    return None
+
+
+def _remember_redirect(request, prefix):
+    if (redirects := _redirects()) is not None:
+        if len(redirects) >= _REDIRECTS_MAX_SIZE:
+            redirects.clear()
+        redirects[request.normalized_host, request.is_secure()] = prefix
+
+
+def _redirect(location):
+    redirect_class = (
+        HttpResponseRedirect if settings.DEBUG else HttpResponsePermanentRedirect
+    )
+    return redirect_class(location)
+
+
+_STOP = object()
+
+
+def _iterate_with_site(iterator, sites, site):
+    iterator = iter(iterator)
+    while True:
+        # Setting the context variables directly avoids clearing the cache
+        # of apps_urlconf for every chunk
+        sites_token, site_token = _sites.set(sites), _current_site.set(site)
+        try:
+            chunk = next(iterator, _STOP)
+        finally:
+            _current_site.reset(site_token)
+            _sites.reset(sites_token)
+        if chunk is _STOP:
+            return
+        yield chunk
+
+
+async def _aiterate_with_site(iterator, sites, site):
+    iterator = iterator.__aiter__()
+    while True:
+        sites_token, site_token = _sites.set(sites), _current_site.set(site)
+        try:
+            chunk = await iterator.__anext__()
+        except StopAsyncIteration:
+            return
+        finally:
+            _current_site.reset(site_token)
+            _sites.reset(sites_token)
+        yield chunk
+
+
+def _stream_with_site(response, sites, site):
+    """
+    Restore the site context while the content of the streaming response is
+    generated
+
+    The content is consumed after the middleware has returned and the
+    context has been reset already. The context is only active while
+    producing chunks, not while the server sends them. File responses are
+    left alone so that servers may still send the file using
+    ``wsgi.file_wrapper``.
+    """
+    if getattr(response, "file_to_stream", None) is not None:
+        return
+    iterate = (
+        _aiterate_with_site
+        if getattr(response, "is_async", False)
+        else _iterate_with_site
+    )
+    response.streaming_content = iterate(response.streaming_content, sites, site)
 
 
-def site_middleware(get_response):
-    site_model = get_site_model()
+def _match_raw_host(request, snapshot):
+    """
+    Return the normalized host and the site matching the raw host of the
+    request, raise ``DisallowedHost`` if no active site matches the host
+    """
+    raw_host = request._get_raw_host()
+    domain, _port = split_domain_port(raw_host)
+    host = _normalize_host(raw_host)
+    if domain and (record := snapshot.hosts.match(host)) is not None:
+        return host, record
+    raise DisallowedHost(
+        "Invalid HTTP_HOST header: %r. No active site matches the host." % raw_host
+    )
 
+
+def site_middleware(get_response):
     def middleware(request):
-        sites = site_model._default_manager.active()
-        if site := site_for_host(request.get_host(), sites=sites):
-            sites = {site.pk: site for site in sites}
-            with set_sites(sites), set_current_site(site):
-                return get_response(request)
-        raise Http404("No configuration found for %r" % request.get_host())
+        _wrote.set(None)
+        snapshot = _load_snapshot()
+        if settings.FEINCMS3_SITES_VALIDATE_HOSTS:
+            # The active sites list all valid hosts, ALLOWED_HOSTS may be
+            # ["*"]. Hosts not matched by any site never reach the default
+            # site.
+            host, record = _match_raw_host(request, snapshot)
+        else:
+            # request.get_host() validates the host against ALLOWED_HOSTS
+            # each time it is called, do it only once.
+            host, record = _normalize_host(request.get_host()), None
+        request.normalized_host = host
+
+        if record := record or snapshot.site_for_host(host):
+            request.site = site = record.instance
+            request.sites = snapshot.sites
+            with set_sites(snapshot.sites), set_current_site(site):
+                response = get_response(request)
+            if getattr(response, "streaming", False):
+                _stream_with_site(response, snapshot.sites, site)
+            return response
+        raise Http404("No configuration found for %r" % host)
 
     return middleware
 
@@ -151,22 +571,30 @@ def redirect_to_site_middleware(get_response):
                 "Current site unknown. Insert site_middleware before redirect_to_site_middleware."
             )
 
+        if not hasattr(request, "normalized_host"):
+            request.normalized_host = _normalize_host(request.get_host())
+
+        # Answer requests to hosts which are known to be redirected without
+        # calling get_host again. The table is consulted here and not in
+        # site_middleware so that the middleware in between (e.g. rate
+        # limits and metrics) still sees all requests.
+        if (redirects := _redirects()) and (
+            prefix := redirects.get((request.normalized_host, request.is_secure()))
+        ):
+            return _redirect(prefix + request.get_full_path())
+
         # Host matches, and either no HTTPS enforcement or already HTTPS
-        if _normalize_host(request.get_host()) == site.get_host() and (
+        if request.normalized_host == site.get_host() and (
             not settings.SECURE_SSL_REDIRECT or request.is_secure()
         ):
             return get_response(request)
 
-        redirect_class = (
-            HttpResponseRedirect if settings.DEBUG else HttpResponsePermanentRedirect
-        )
-        return redirect_class(
-            "http{}://{}{}".format(
-                "s" if (settings.SECURE_SSL_REDIRECT or request.is_secure()) else "",
-                site.get_host(),
-                request.get_full_path(),
-            )
+        prefix = "http{}://{}".format(
+            "s" if (settings.SECURE_SSL_REDIRECT or request.is_secure()) else "",
+            site.get_host(),
         )
+        _remember_redirect(request, prefix)
+        return _redirect(prefix + request.get_full_path())
 
     return middleware
 
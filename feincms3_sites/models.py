@@ -10,7 +10,9 @@ from django.utils.translation import gettext_lazy as _
 from feincms3 import pages
 from feincms3.utils import ChoicesCharField, validation_error
 
+from feincms3_sites.hosts import host_re_time, shadowed_sites
 from feincms3_sites.middleware import current_site, site_for_host
+from feincms3_sites.routers import database_for_site, site_router_installed
 from feincms3_sites.utils import import_callable
 
 
@@ -20,6 +22,38 @@ if not hasattr(settings, "FEINCMS3_SITES_SITE_MODEL"):  # pragma: no cover
     settings.FEINCMS3_SITES_SITE_MODEL = "feincms3_sites.Site"
 if not hasattr(settings, "FEINCMS3_SITES_SITE_GET_HOST"):  # pragma: no cover
     settings.FEINCMS3_SITES_SITE_GET_HOST = None
+if not hasattr(settings, "FEINCMS3_SITES_SNAPSHOT_TIMEOUT"):  # pragma: no cover
+    settings.FEINCMS3_SITES_SNAPSHOT_TIMEOUT = 60
+if not hasattr(settings, "FEINCMS3_SITES_VERSION_CHECK_INTERVAL"):  # pragma: no cover
+    settings.FEINCMS3_SITES_VERSION_CHECK_INTERVAL = 1
+if not hasattr(settings, "FEINCMS3_SITES_CACHE_ALIAS"):  # pragma: no cover
+    settings.FEINCMS3_SITES_CACHE_ALIAS = "default"
+if not hasattr(settings, "FEINCMS3_SITES_RESOLUTION_FIELDS"):  # pragma: no cover
+    settings.FEINCMS3_SITES_RESOLUTION_FIELDS = []
+if not hasattr(settings, "FEINCMS3_SITES_HOST_RE_BUDGET"):  # pragma: no cover
+    settings.FEINCMS3_SITES_HOST_RE_BUDGET = 0.01
+if not hasattr(settings, "FEINCMS3_SITES_HOST_RE_SAMPLE_INTERVAL"):  # pragma: no cover
+    settings.FEINCMS3_SITES_HOST_RE_SAMPLE_INTERVAL = 100
+if not hasattr(settings, "FEINCMS3_SITES_HOST_RE_STRIKES"):  # pragma: no cover
+    settings.FEINCMS3_SITES_HOST_RE_STRIKES = 3
+if not hasattr(settings, "FEINCMS3_SITES_VALIDATE_HOSTS"):  # pragma: no cover
+    settings.FEINCMS3_SITES_VALIDATE_HOSTS = False
+if not hasattr(settings, "FEINCMS3_SITES_DATABASES"):  # pragma: no cover
+    settings.FEINCMS3_SITES_DATABASES = {}
+if not hasattr(settings, "FEINCMS3_SITES_READ_DATABASE"):  # pragma: no cover
+    settings.FEINCMS3_SITES_READ_DATABASE = None
+if not hasattr(settings, "FEINCMS3_SITES_READ_DATABASE_DELAY"):  # pragma: no cover
+    settings.FEINCMS3_SITES_READ_DATABASE_DELAY = 10
+if not hasattr(settings, "FEINCMS3_SITES_RATE_LIMITS"):  # pragma: no cover
+    settings.FEINCMS3_SITES_RATE_LIMITS = {}
+if not hasattr(settings, "FEINCMS3_SITES_RATE_LIMIT_SHARED"):  # pragma: no cover
+    settings.FEINCMS3_SITES_RATE_LIMIT_SHARED = False
+if not hasattr(settings, "FEINCMS3_SITES_METRICS_INTERVAL"):  # pragma: no cover
+    settings.FEINCMS3_SITES_METRICS_INTERVAL = 60
+if not hasattr(settings, "FEINCMS3_SITES_METRICS_SINK"):  # pragma: no cover
+    settings.FEINCMS3_SITES_METRICS_SINK = "feincms3_sites.metrics.log_sink"
+if not hasattr(settings, "FEINCMS3_SITES_MAX_URLCONFS"):  # pragma: no cover
+    settings.FEINCMS3_SITES_MAX_URLCONFS = 100
 
 
 class SiteQuerySet(models.QuerySet):
@@ -110,6 +144,44 @@ class AbstractSite(models.Model):
                     _("The regular expression does not match the host.")
                 )
 
+        # Managed regexes only match the literal host and are always fast
+        if not self.is_managed_re:
+            budget = settings.FEINCMS3_SITES_HOST_RE_BUDGET
+            if host_re_time(self.host_re, budget=budget) > budget:
+                raise ValidationError(
+                    _(
+                        "The regular expression is too slow, matching long hosts"
+                        " takes more than %s seconds."
+                    )
+                    % budget
+                )
+
+        if self.is_active:
+            self._clean_shadowed_sites()
+
+    def _clean_shadowed_sites(self):
+        others = (
+            self.__class__._default_manager.active()
+            .exclude(pk=self.pk)
+            .only("pk", "is_default", "host", "host_re")
+        )
+        errors = []
+        for site, resolved in shadowed_sites([self, *others], only=self):
+            if site is self:
+                errors.append(
+                    _("The host is already matched by the site %s.") % resolved
+                )
+            else:
+                errors.append(
+                    _(
+                        "The regular expression also matches the host of the"
+                        " site %s which would not be reachable anymore."
+                    )
+                    % site
+                )
+        if errors:
+            raise ValidationError(errors)
+
     def get_host(self):
         return self.host
 
@@ -156,7 +228,19 @@ class SiteForeignKey(models.ForeignKey):
 
 class AbstractPageQuerySet(pages.AbstractPageQuerySet):
     def active(self, *, site=None):
-        return self.filter(is_active=True, site=site or current_site())
+        site = site or current_site()
+        # Site records cannot be used as filter values
+        queryset = self.filter(is_active=True, site=getattr(site, "pk", site))
+        # Read from the database of the site unless a database has been
+        # selected explicitly. Only SiteRouter sends writes back to the
+        # default database.
+        if (
+            self._db is None
+            and (alias := database_for_site(site))
+            and site_router_installed()
+        ):
+            queryset = queryset.using(alias)
+        return queryset
 
 
 class AbstractPage(pages.AbstractPage):
@@ -0,0 +1,113 @@
+import math
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.http import HttpResponse
+
+from feincms3_sites.middleware import current_site
+
+
+class TokenBucket:
+    """
+    Token bucket holding up to ``capacity`` tokens, refilled with ``rate``
+    tokens per second
+    """
+
+    __slots__ = ("_lock", "capacity", "rate", "tokens", "updated")
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self):
+        """
+        Take a token and return ``0``, or return the number of seconds until
+        the next token is available if the bucket is empty
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+
+# (site.pk, rate, capacity) -> TokenBucket
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def _rate_limit(site):
+    limits = settings.FEINCMS3_SITES_RATE_LIMITS
+    return limits.get(site.host) or limits.get("*")
+
+
+def _take_local(site, rate, capacity):
+    key = (site.pk, rate, capacity)
+    if (bucket := _buckets.get(key)) is None:
+        with _buckets_lock:
+            bucket = _buckets.setdefault(key, TokenBucket(rate, capacity))
+    return bucket.take()
+
+
+def _take_shared(site, rate, capacity):
+    # Atomic token buckets are not possible with the cache API, count the
+    # requests in fixed windows which refill the whole bucket instead.
+    period = capacity / rate
+    now = time.time()
+    window = int(now // period)
+    cache = caches[settings.FEINCMS3_SITES_CACHE_ALIAS]
+    key = f"feincms3-sites:rate-limit:{site.pk}:{rate}:{capacity}:{window}"
+    cache.add(key, 0, timeout=math.ceil(period) + 1)
+    try:
+        count = cache.incr(key)
+    except ValueError:  # The key has been evicted in the meantime
+        return 0
+    return 0 if count <= capacity else (window + 1) * period - now
+
+
+def site_rate_limit_middleware(get_response):
+    """
+    Limit the number of requests per site
+
+    ``FEINCMS3_SITES_RATE_LIMITS`` maps site hosts to ``(rate, capacity)``
+    tuples; sites may make bursts of up to ``capacity`` requests, afterwards
+    ``rate`` requests per second are allowed. The ``"*"`` key applies to all
+    sites without their own limit. Limits are enforced per process unless
+    ``FEINCMS3_SITES_RATE_LIMIT_SHARED`` is set, in which case requests are
+    counted in the ``FEINCMS3_SITES_CACHE_ALIAS`` cache.
+
+    Add the middleware directly after ``site_middleware`` so that rejected
+    requests are answered before any other work is done.
+    """
+
+    def middleware(request):
+        site = current_site()
+        if not site:
+            raise ImproperlyConfigured(
+                "Current site unknown. Insert site_middleware before site_rate_limit_middleware."
+            )
+
+        if limit := _rate_limit(site):
+            take = (
+                _take_shared
+                if settings.FEINCMS3_SITES_RATE_LIMIT_SHARED
+                else _take_local
+            )
+            if retry_after := take(site, *limit):
+                response = HttpResponse("Too Many Requests", status=429)
+                response["Retry-After"] = str(math.ceil(retry_after))
+                return response
+        return get_response(request)
+
+    return middleware
@@ -0,0 +1,73 @@
+from functools import cache
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, router
+
+from feincms3_sites.middleware import current_site
+from feincms3_sites.utils import get_site_model
+
+
+def database_for_site(site):
+    """
+    Return the database alias configured for the site in
+    ``FEINCMS3_SITES_DATABASES`` or ``None``
+
+    The setting maps site hosts to database aliases, e.g.
+    ``{"large-tenant.com": "tenant-replica"}``.
+    """
+    if host := getattr(site, "host", None):
+        return settings.FEINCMS3_SITES_DATABASES.get(host)
+    return None
+
+
+@cache
+def _has_site_foreign_key(model):
+    site_model = get_site_model()
+    return any(
+        field.many_to_one and field.related_model is site_model
+        for field in model._meta.concrete_fields
+    )
+
+
+class SiteRouter:
+    """
+    Database router sending reads of models with a foreign key to the site
+    model to the database of the current site
+
+    Add ``"feincms3_sites.routers.SiteRouter"`` to ``DATABASE_ROUTERS`` and
+    configure the databases using ``FEINCMS3_SITES_DATABASES``. Writes of
+    those models always go to the default database, even for instances read
+    from the database of a site. All other models are left to the following
+    routers.
+
+    The router only knows the current site. ``AbstractPageQuerySet.active()``
+    uses the database of the site passed to it, but only if the site is a
+    site instance or record; ``active(site=<pk>)`` isn't routed since the
+    host of the site is unknown. Without the router ``active()`` doesn't use
+    ``FEINCMS3_SITES_DATABASES`` either since instances would be saved to the
+    database they have been read from.
+    """
+
+    def db_for_read(self, model, **hints):
+        if _has_site_foreign_key(model) and (site := current_site()):
+            return database_for_site(site)
+        return None
+
+    def db_for_write(self, model, **hints):
+        # Do not fall back to the database the instance has been read from
+        if _has_site_foreign_key(model):
+            return DEFAULT_DB_ALIAS
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *settings.FEINCMS3_SITES_DATABASES.values()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+
+def site_router_installed():
+    """
+    Return whether ``SiteRouter`` is one of the ``DATABASE_ROUTERS``
+    """
+    return any(isinstance(instance, SiteRouter) for instance in router.routers)
@@ -0,0 +1,10 @@
+from django.dispatch import Signal
+
+
+#: Sent when a host regex has been too slow repeatedly and is skipped when
+#: resolving hosts. The regex is tested again when the snapshot of sites is
+#: rebuilt, that is when sites change or after
+#: ``FEINCMS3_SITES_SNAPSHOT_TIMEOUT`` seconds, so slow regexes are reported
+#: periodically until they are fixed. Receives the site record (``site``) and
+#: the time the last search took in seconds (``elapsed``).
+host_re_quarantined = Signal()
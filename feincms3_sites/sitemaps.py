@@ -0,0 +1,148 @@
+from itertools import islice
+from xml.sax.saxutils import escape
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import QuerySet
+from django.http import Http404, StreamingHttpResponse
+
+from feincms3_sites.middleware import build_absolute_uri, current_site
+
+
+#: The maximum number of URLs allowed in a single sitemap by the protocol
+MAX_URLS = 50000
+
+_XMLNS = "http://www.sitemaps.org/schemas/sitemap/0.9"
+
+
+def _count(items):
+    return items.count() if isinstance(items, QuerySet) else len(items)
+
+
+def _iterate(items, *, chunk_size):
+    if isinstance(items, QuerySet):
+        return items.iterator(chunk_size=chunk_size)
+    return iter(items)
+
+
+def _stable(items):
+    """
+    Add the primary key to the ordering of querysets so that slices of
+    consecutive sitemap pages neither overlap nor skip objects
+    """
+    if not isinstance(items, QuerySet):
+        return items
+    query = items.query
+    if query.order_by:
+        ordering = query.order_by
+    elif "tree_ordering" in query.annotations:
+        # django-tree-queries orders by the tree if no ordering is given
+        ordering = ("tree_ordering",)
+    elif query.default_ordering:
+        ordering = query.get_meta().ordering
+    else:
+        ordering = ()
+    return items.order_by(*ordering, "pk")
+
+
+def _window(querysets, *, offset, limit, chunk_size):
+    """
+    Yield up to ``limit`` objects from the concatenation of all querysets,
+    skipping the first ``offset`` objects. ``querysets`` is a list of
+    ``(items, count)`` tuples. Querysets are sliced so that the database only
+    returns the rows which are actually needed.
+    """
+    for items, count in querysets:
+        if limit <= 0:
+            return
+        if offset >= count:
+            offset -= count
+            continue
+        stop = min(count, offset + limit)
+        yield from _iterate(_stable(items)[offset:stop], chunk_size=chunk_size)
+        limit -= stop - offset
+        offset = 0
+
+
+def _urlset(objects, *, site, chunk_size):
+    yield f'<?xml version="1.0" encoding="UTF-8"?>\n<urlset xmlns="{_XMLNS}">\n'
+    objects = iter(objects)
+    while True:
+        chunk = "".join(
+            "<url><loc>%s</loc></url>\n"
+            % escape(build_absolute_uri(obj.get_absolute_url(), site=site))
+            for obj in islice(objects, chunk_size)
+        )
+        if not chunk:
+            break
+        yield chunk
+    yield "</urlset>\n"
+
+
+def _sitemapindex(locations):
+    yield f'<?xml version="1.0" encoding="UTF-8"?>\n<sitemapindex xmlns="{_XMLNS}">\n'
+    for location in locations:
+        yield "<sitemap><loc>%s</loc></sitemap>\n" % escape(location)
+    yield "</sitemapindex>\n"
+
+
+def sitemap(request, *, sections, limit=MAX_URLS, chunk_size=2000):
+    """
+    Stream the sitemap of the current site
+
+    ``sections`` is a list of callables which receive the current site and
+    return a queryset (or any other sequence) of objects with a
+    ``get_absolute_url`` method. Querysets are iterated using
+    ``.iterator()`` so that memory usage stays constant even for sites with
+    hundreds of thousands of URLs::
+
+        path(
+            "sitemap.xml",
+            sitemap,
+            {"sections": [lambda site: Page.objects.active(site=site)]},
+        )
+
+    If the sections contain more than ``limit`` URLs the view returns a
+    sitemap index instead which references the individual sitemaps using a
+    ``p`` query parameter (``sitemap.xml?p=1``, ``sitemap.xml?p=2`` etc.)
+    """
+    if not (site := current_site()):
+        raise ImproperlyConfigured(
+            "Current site unknown. Insert site_middleware before using the sitemap view."
+        )
+
+    querysets = [
+        (items, _count(items)) for items in (section(site) for section in sections)
+    ]
+    total = sum(count for _items, count in querysets)
+
+    if (page := request.GET.get("p")) is None:
+        if total > limit:
+            return StreamingHttpResponse(
+                _sitemapindex(
+                    build_absolute_uri(f"{request.path}?p={number}", site=site)
+                    for number in range(1, (total - 1) // limit + 2)
+                ),
+                content_type="application/xml",
+            )
+        page = 1
+
+    try:
+        page = int(page)
+    except ValueError as exc:
+        raise Http404("Invalid sitemap page %r" % page) from exc
+    if page < 1 or (page > 1 and (page - 1) * limit >= total):
+        raise Http404("Invalid sitemap page %r" % page)
+
+    return StreamingHttpResponse(
+        _urlset(
+            _window(
+                querysets,
+                offset=(page - 1) * limit,
+                limit=limit,
+                chunk_size=chunk_size,
+            ),
+            site=site,
+            chunk_size=chunk_size,
+        ),
+        content_type="application/xml",
+    )
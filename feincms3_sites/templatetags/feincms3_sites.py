@@ -0,0 +1,19 @@
+from django import template
+
+from feincms3_sites.middleware import build_absolute_uris
+
+
+register = template.Library()
+
+
+@register.filter
+def with_absolute_urls(objects):
+    """
+    Return a list of ``(object, absolute_url)`` tuples, e.g.::
+
+        {% for article, url in articles|with_absolute_urls %}
+          <a href="{{ url }}">{{ article }}</a>
+        {% endfor %}
+    """
+    objects = list(objects)
+    return list(zip(objects, build_absolute_uris(objects)))
@@ -0,0 +1,104 @@
+import sys
+import threading
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.urls import clear_url_caches, get_urlconf
+from feincms3.applications import apps_urlconf
+
+
+# Module names of generated URLconfs in least recently used order
+_urlconfs = OrderedDict()
+# Module names of evicted URLconfs which have not been removed yet
+_evicted = set()
+# Number of requests using a module name right now
+_in_use = Counter()
+_urlconfs_lock = threading.Lock()
+
+
+def site_apps_urlconf(*, apps=None):
+    """
+    Return the URLconf including the applications like
+    ``feincms3.applications.apps_urlconf`` but keep at most
+    ``FEINCMS3_SITES_MAX_URLCONFS`` generated URLconf modules
+
+    Sites with the same applications already share their URLconf module
+    since its name is derived from the applications. The least recently used
+    modules are evicted. Once as many modules have been evicted as are kept,
+    the evicted modules which aren't in use by a request anymore are removed
+    from ``sys.modules`` and Django's URL caches are cleared since resolvers
+    cannot be dropped individually. Evicted URLconfs are generated again when
+    they are needed the next time.
+    """
+    urlconf = apps_urlconf(apps=apps)
+    if urlconf != settings.ROOT_URLCONF:
+        _remember_urlconf(urlconf)
+    return urlconf
+
+
+def _remember_urlconf(urlconf):
+    if (max_urlconfs := settings.FEINCMS3_SITES_MAX_URLCONFS) is None:
+        return
+
+    removed = []
+    with _urlconfs_lock:
+        _evicted.discard(urlconf)
+        _urlconfs[urlconf] = None
+        _urlconfs.move_to_end(urlconf)
+        while len(_urlconfs) > max_urlconfs:
+            _evicted.add(_urlconfs.popitem(last=False)[0])
+
+        if len(_evicted) >= max(max_urlconfs, 1):
+            current = get_urlconf()
+            removed = [
+                name for name in _evicted if name != current and not _in_use[name]
+            ]
+            _evicted.difference_update(removed)
+
+    if removed:
+        for name in removed:
+            sys.modules.pop(name, None)
+        clear_url_caches()
+
+
+def _release_urlconf(urlconf):
+    with _urlconfs_lock:
+        _in_use[urlconf] -= 1
+        if not _in_use[urlconf]:
+            del _in_use[urlconf]
+
+
+@contextmanager
+def _urlconf_in_use(urlconf, generate):
+    """
+    Keep the evicted URLconf from being removed while it is used
+
+    ``generate`` is called to generate the URLconf again if it has already
+    been removed by another thread.
+    """
+    while True:
+        with _urlconfs_lock:
+            _in_use[urlconf] += 1
+        if urlconf in sys.modules:
+            break
+        _release_urlconf(urlconf)
+        urlconf = generate()
+    try:
+        yield urlconf
+    finally:
+        _release_urlconf(urlconf)
+
+
+def apps_middleware(get_response):
+    """
+    Replacement for ``feincms3.applications.apps_middleware`` which uses
+    ``site_apps_urlconf`` so that the number of URLconfs stays bounded
+    """
+
+    def middleware(request):
+        with _urlconf_in_use(site_apps_urlconf(), site_apps_urlconf) as urlconf:
+            request.urlconf = urlconf
+            return get_response(request)
+
+    return middleware
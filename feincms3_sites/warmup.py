@@ -0,0 +1,65 @@
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.urls import get_resolver
+from django.utils.translation import override
+from feincms3 import applications
+
+from feincms3_sites.middleware import load_sites
+from feincms3_sites.urlconfs import site_apps_urlconf
+
+
+def _build_urlconf(apps):
+    urlconf = site_apps_urlconf(apps=apps)
+    resolver = get_resolver(urlconf)
+    # Reverse dictionaries are populated per language
+    for language_code, _name in settings.LANGUAGES:
+        with override(language_code):
+            resolver.reverse_dict  # noqa: B018
+    return urlconf
+
+
+def warm_up(*, max_workers=None):
+    """
+    Preload the per-process caches of all active sites
+
+    Loads the snapshot of active sites including their compiled host regular
+    expressions and builds the application URLconfs including Django's URL
+    resolvers. Meant to be called from post-fork hooks so that the first
+    requests after a deployment do not pay for cold caches, e.g. in a gunicorn
+    configuration file::
+
+        def post_worker_init(worker):
+            from feincms3_sites.warmup import warm_up
+
+            warm_up(max_workers=4)
+
+    The database is only queried in the calling thread. URLconfs are built in
+    a thread pool if ``max_workers`` is given. At most
+    ``FEINCMS3_SITES_MAX_URLCONFS`` URLconfs are built, those shared by most
+    sites first; building more would only evict them again. Returns a
+    dictionary mapping the primary keys of the sites whose URLconf has been
+    built to URLconf module names.
+    """
+    sites = load_sites()
+
+    manager = applications._APPS_MODEL._default_manager
+    apps = {pk: manager.active(site=site).applications() for pk, site in sites.items()}
+    apps = {pk: tuple(map(tuple, value)) for pk, value in apps.items()}
+    # Sites with the same applications share their URLconf. Only build as
+    # many URLconfs as are kept, those used by most sites first.
+    # Sites without applications use ROOT_URLCONF which doesn't count.
+    counts = Counter(value for value in apps.values() if value)
+    distinct = [
+        value
+        for value, _count in counts.most_common(settings.FEINCMS3_SITES_MAX_URLCONFS)
+    ]
+    if len(counts) < len(set(apps.values())):
+        distinct.append(())
+    if max_workers:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            urlconfs = dict(zip(distinct, executor.map(_build_urlconf, distinct)))
+    else:
+        urlconfs = {value: _build_urlconf(value) for value in distinct}
+    return {pk: urlconfs[value] for pk, value in apps.items() if value in urlconfs}
@@ -1,19 +1,59 @@
+import contextvars
+import io
+import itertools
+import json
+import re
+import sys
+import tempfile
+from types import MappingProxyType, SimpleNamespace
+from unittest import mock
+
 import django
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.cache import caches
 from django.core.exceptions import ImproperlyConfigured, ValidationError
-from django.test import Client, TestCase
+from django.core.management import CommandError, call_command
+from django.db import router
+from django.http import FileResponse, HttpResponse
+from django.http.request import validate_host
+from django.template import Context, Template
+from django.test import Client, RequestFactory, SimpleTestCase, TestCase
 from django.test.utils import isolate_apps, override_settings
-from django.urls import set_urlconf
+from django.urls import clear_url_caches, get_resolver, reverse, set_urlconf
+from django.urls.resolvers import _get_cached_resolver
 from django.utils.translation import deactivate_all, override
 from feincms3.applications import NoReverseMatch, _del_apps_urlconf_cache, apps_urlconf
 
+from feincms3_sites import context_processors
+from feincms3_sites.cache import (
+    _cache_timeout,
+    invalidate_site,
+    site_cache_key,
+    site_generation,
+)
+from feincms3_sites.checks import check_sites
+from feincms3_sites.hosts import (
+    HostIndex,
+    analyze_host_re,
+    host_re_time,
+    shadowed_sites,
+)
+from feincms3_sites.metrics import LATENCY_BUCKETS, collector
 from feincms3_sites.middleware import (
     _del_reverse_site_cache,
+    _sites_state,
+    _stream_with_site,
     build_absolute_uri,
+    build_absolute_uris,
+    current_site,
+    invalidate_sites,
+    load_sites,
+    reverse_site_app,
     set_current_site,
     set_sites,
     site_for_host,
+    site_middleware,
 )
 from feincms3_sites.models import (
     AbstractPage,
@@ -21,7 +61,18 @@ from feincms3_sites.models import (
     Site,
     validate_language_codes,
 )
+from feincms3_sites.ratelimit import TokenBucket, _buckets
+from feincms3_sites.routers import SiteRouter, database_for_site
+from feincms3_sites.signals import host_re_quarantined
+from feincms3_sites.sitemaps import _stable
+from feincms3_sites.urlconfs import (
+    _evicted,
+    _urlconf_in_use,
+    _urlconfs,
+    site_apps_urlconf,
+)
 from feincms3_sites.utils import get_site_model, import_callable
+from feincms3_sites.warmup import warm_up
 from testapp.models import Article, CustomSite, Page
 
 
@@ -117,6 +168,39 @@ class AppsMiddlewareTest(TestCase):
         # print(response.content.decode('utf-8'))
         self.assertContains(response, "The site is required when creating root nodes.")
 
+    @override_settings(
+        MIDDLEWARE=[
+            *settings.MIDDLEWARE,
+            "feincms3_sites.middleware.site_middleware",
+            "feincms3_sites.urlconfs.apps_middleware",
+        ],
+        FEINCMS3_SITES_MAX_URLCONFS=1,
+    )
+    def test_site_apps_middleware(self):
+        home = Page.objects.create(
+            title="home",
+            slug="home",
+            path="/de/",
+            static_path=True,
+            language_code="de",
+            is_active=True,
+            site=self.test_site,
+        )
+        Page.objects.create(
+            title="blog",
+            slug="blog",
+            language_code="de",
+            is_active=True,
+            page_type="blog",
+            parent_id=home.pk,
+            site=self.test_site,
+        )
+        Article.objects.create(title="article", category="blog", site=self.test_site)
+
+        self.assertContains(self.client.get("/de/blog/"), 'class="article"', 1)
+        self.assertContains(self.client.get("/de/blog/"), 'class="article"', 1)
+        self.assertEqual(len(_urlconfs), 1)
+
     def test_apps(self):
         """Article app test (two instance namespaces, two languages)"""
 
@@ -251,6 +335,41 @@ class AppsMiddlewareTest(TestCase):
         with set_current_site(page.site):
             self.assertEqual(apps_urlconf(), "urlconf_01c07a48384868b2300536767c9879e2")
 
+    def test_site_records(self):
+        """Querysets and reverse_site_app accept site records"""
+
+        page = Page.objects.create(
+            title="blog",
+            slug="blog",
+            static_path=False,
+            language_code="en",
+            is_active=True,
+            page_type="blog",
+            site=self.test_site,
+        )
+        article = Article.objects.create(
+            title="article", category="blog", site=self.test_site
+        )
+
+        record = load_sites()[self.test_site.pk]
+        self.assertEqual(list(Page.objects.active(site=record)), [page])
+        self.assertEqual(
+            reverse_site_app(
+                ("blog", "articles"),
+                "article-detail",
+                kwargs={"pk": article.pk},
+                site=record,
+            ),
+            f"http://testserver/blog/{article.pk}/",
+        )
+
+        # Removed URLconfs are generated again
+        for urlconf in _urlconfs:
+            sys.modules.pop(urlconf)
+        self.assertEqual(
+            article.get_absolute_url(), f"http://testserver/blog/{article.pk}/"
+        )
+
     def test_reverse_site_app_caching(self):
         """reverse_site_app caches URLconf module names and doesn't repeat queries"""
 
@@ -309,6 +428,118 @@ class AppsMiddlewareTest(TestCase):
                     f"http://testserver2/blog/{a2.pk}/",
                 )
 
+    def test_build_absolute_uris(self):
+        """Sites are only resolved once when building many absolute URLs"""
+        site2 = Site.objects.create(host="testserver2")
+        for site in (self.test_site, site2):
+            Page.objects.create(
+                title="blog",
+                slug="blog",
+                static_path=False,
+                language_code="en",
+                is_active=True,
+                page_type="blog",
+                site=site,
+            )
+            for i in range(3):
+                Article.objects.create(title=f"{i}", category="blog", site=site)
+
+        articles = list(Article.objects.order_by("pk"))
+        with self.assertNumQueries(3):
+            # 1. hosts
+            # 2. and 3. pages with apps for both sites
+            urls = list(build_absolute_uris(articles))
+
+        self.assertEqual(
+            urls,
+            [f"http://{article.site.host}/blog/{article.pk}/" for article in articles],
+        )
+
+        _del_reverse_site_cache()
+        self.assertEqual(
+            Template(
+                "{% load feincms3_sites %}"
+                "{% for article, url in articles|with_absolute_urls %}"
+                "{{ article }}:{{ url }}\n"
+                "{% endfor %}"
+            ).render(Context({"articles": articles[:2]})),
+            "".join(
+                f"{article}:http://testserver/blog/{article.pk}/\n"
+                for article in articles[:2]
+            ),
+        )
+
+    def test_sites_snapshot(self):
+        """Sites are only loaded once outside of requests"""
+        invalidate_sites()
+        with self.assertNumQueries(1):
+            for _i in range(3):
+                self.assertEqual(
+                    build_absolute_uri("/test/", site=self.test_site.pk),
+                    "http://testserver/test/",
+                )
+            self.assertIs(load_sites(), load_sites())
+
+        self.test_site.host = "testserver2"
+        self.test_site.save()
+        with self.assertNumQueries(1), set_sites(load_sites()):
+            self.assertEqual(
+                build_absolute_uri("/test/", site=self.test_site.pk),
+                "http://testserver2/test/",
+            )
+
+        with (
+            override_settings(FEINCMS3_SITES_SNAPSHOT_TIMEOUT=0),
+            self.assertNumQueries(2),
+        ):
+            build_absolute_uri("/test/", site=self.test_site.pk)
+            build_absolute_uri("/test/", site=self.test_site.pk)
+
+        site = Site.objects.create(host="testserver3")
+        self.assertIn(site.pk, load_sites())
+        site.delete()
+        self.assertNotIn(site.pk, load_sites())
+
+    def test_warm_up(self):
+        site2 = Site.objects.create(host="testserver2")
+        site3 = Site.objects.create(host="testserver3")
+        for site in (self.test_site, site2):
+            Page.objects.create(
+                title="blog",
+                slug="blog",
+                static_path=False,
+                language_code="en",
+                is_active=True,
+                page_type="blog",
+                site=site,
+            )
+
+        with self.assertNumQueries(4):
+            # 1. hosts
+            # 2. to 4. pages with apps for all sites
+            urlconfs = warm_up()
+        self.assertEqual(urlconfs, warm_up(max_workers=2))
+
+        self.assertEqual(urlconfs[site3.pk], "testapp.urls")
+        self.assertEqual(urlconfs[self.test_site.pk], urlconfs[site2.pk])
+        self.assertIn(urlconfs[site2.pk], sys.modules)
+        with set_current_site(site2):
+            self.assertEqual(apps_urlconf(), urlconfs[site2.pk])
+
+        # Only URLconfs which are kept are built, those of most sites first
+        site4 = Site.objects.create(host="testserver4")
+        Page.objects.create(
+            title="news",
+            slug="news",
+            static_path=False,
+            language_code="en",
+            is_active=True,
+            page_type="blog",
+            site=site4,
+        )
+        with override_settings(FEINCMS3_SITES_MAX_URLCONFS=1):
+            self.assertEqual(warm_up(), urlconfs)
+
     def test_site_model(self):
         """Test various aspects of the Site model"""
         # No problems
@@ -437,6 +668,42 @@ class AppsMiddlewareTest(TestCase):
                 "https://testserver/test/",
             )
 
+    def test_absolute_uri_memoization(self):
+        site = Site(pk=3, host="bläb.example.com")
+        calls = []
+
+        def get_host():
+            calls.append(1)
+            return site.host
+
+        site.get_host = get_host
+        with set_sites({3: site}):
+            self.assertEqual(
+                build_absolute_uri("/tést/", site=3),
+                "http://bl%C3%A4b.example.com/t%C3%A9st/",
+            )
+            self.assertEqual(
+                build_absolute_uri("test/?a=b", site=3),
+                "http://bl%C3%A4b.example.com/test/?a=b",
+            )
+            self.assertEqual(
+                build_absolute_uri("//example.org/", site=3),
+                "http://example.org/",
+            )
+        self.assertEqual(len(calls), 1)
+
+        site = Site(pk=4, host="example.com")
+        site.get_absolute_url = lambda: "http://example.com/prefix/"
+        with set_sites({4: site}):
+            self.assertEqual(
+                build_absolute_uri("/test/", site=4),
+                "http://example.com/test/",
+            )
+            self.assertEqual(
+                build_absolute_uri("test/", site=4),
+                "http://example.com/prefix/test/",
+            )
+
 
 @override_settings(
     MIDDLEWARE=[
@@ -468,6 +735,149 @@ class SiteMiddlewareTest(TestCase):
         response = self.client.get("/de/", headers={"host": "TestServer2"})
         self.assertContains(response, "home - testapp")
 
+    @override_settings(MIDDLEWARE=["feincms3_sites.middleware.site_middleware"])
+    def test_shared_snapshot(self):
+        site = Site.objects.create(host="testserver", is_default=True)
+
+        def view(request):
+            return request.sites
+
+        with self.assertNumQueries(1):
+            first = site_middleware(view)(RequestFactory().get("/"))
+        with self.assertNumQueries(0):
+            self.assertIs(site_middleware(view)(RequestFactory().get("/")), first)
+        self.assertIsInstance(first, MappingProxyType)
+        self.assertEqual(list(first), [site.pk])
+        self.assertEqual(first[site.pk].instance, site)
+
+        # Another process changed a site
+        Site.objects.filter(pk=site.pk).update(host="example.com")
+        caches["default"].set("feincms3-sites:sites-version", "changed")
+        second = site_middleware(view)(RequestFactory().get("/"))
+        self.assertIsNot(second, first)
+        self.assertEqual(second[site.pk].host, "example.com")
+
+        # Bulk updates
+        Site.objects.filter(pk=site.pk).update(host="example.org")
+        invalidate_sites()
+        third = site_middleware(view)(RequestFactory().get("/"))
+        self.assertEqual(third[site.pk].host, "example.org")
+
+    def test_version_check_interval(self):
+        Site.objects.create(host="example.com")
+        sites = load_sites()
+        with mock.patch.object(
+            caches["default"], "get", wraps=caches["default"].get
+        ) as get:
+            self.assertIs(load_sites(), sites)
+            self.assertEqual(get.call_count, 0)
+
+            caches["default"].set("feincms3-sites:sites-version", "changed")
+            self.assertIs(load_sites(), sites)
+
+            _sites_state.snapshot.checked -= 1
+            self.assertIsNot(load_sites(), sites)
+            self.assertEqual(get.call_count, 1)
+
+    def test_site_records(self):
+        site = Site.objects.create(host="example.com", default_language="de")
+        invalidate_sites()
+        with self.assertNumQueries(1):
+            record = load_sites()[site.pk]
+            self.assertEqual(repr(record), f"<SiteRecord: example.com ({site.pk})>")
+            self.assertEqual(str(record), "example.com")
+            self.assertEqual(record.get_absolute_url(), "http://example.com")
+            # Instances aren't shared between requests and threads
+            self.assertIsNot(record.instance, record.instance)
+            self.assertEqual(record.instance, site)
+            self.assertEqual(record.instance.default_language, "de")
+        with self.assertNumQueries(1):
+            # Deferred
+            self.assertTrue(record.instance.is_active)
+
+        with self.assertRaisesRegex(AttributeError, "read-only"):
+            record.host = "example.org"
+        with self.assertRaises(AttributeError):
+            record.is_active  # noqa: B018
+
+    @override_settings(FEINCMS3_SITES_RESOLUTION_FIELDS=["is_active"])
+    def test_resolution_fields(self):
+        site = Site.objects.create(host="example.com", is_default=True)
+        with self.assertNumQueries(1):
+            record = load_sites()[site.pk]
+            self.assertTrue(record.is_active)
+            self.assertTrue(record.instance.is_active)
+
+        with self.assertNumQueries(1):
+            instance = site_for_host("example.com")
+            self.assertEqual(instance, site)
+            self.assertTrue(instance.is_active)
+        self.assertEqual(instance.get_deferred_fields(), {"is_managed_re"})
+
+
+@override_settings(MIDDLEWARE=["feincms3_sites.middleware.site_middleware"])
+class StreamingTest(TestCase):
+    def setUp(self):
+        Site.objects.create(host="testserver", is_default=True)
+
+    def test_streaming(self):
+        response = self.client.get("/stream/")
+        self.assertIsNone(current_site())
+        self.assertEqual(b"".join(response.streaming_content), b"testserver\n" * 3)
+        self.assertIsNone(current_site())
+
+    async def test_async_streaming(self):
+        response = await self.async_client.get("/stream/?async")
+        self.assertTrue(response.is_async)
+        self.assertEqual(
+            b"".join([chunk async for chunk in response.streaming_content]),
+            b"testserver\n" * 3,
+        )
+        self.assertIsNone(current_site())
+
+    def test_file_response(self):
+        with open(__file__, "rb") as file:
+            response = FileResponse(file)
+            _stream_with_site(response, {}, None)
+            self.assertIs(response.file_to_stream, file)
+
+
+class HostReQuarantineTest(TestCase):
+    def test_quarantine(self):
+        default = Site.objects.create(host="example.com", is_default=True)
+        site = Site.objects.create(
+            host="example.org", host_re=r"example\.org$", is_managed_re=False
+        )
+        received = []
+
+        def receiver(sender, *, site, elapsed, **kwargs):
+            received.append((sender, site.pk))
+
+        host_re_quarantined.connect(receiver)
+        self.addCleanup(host_re_quarantined.disconnect, receiver)
+
+        with (
+            override_settings(
+                MIDDLEWARE=["feincms3_sites.middleware.site_middleware"],
+                FEINCMS3_SITES_HOST_RE_BUDGET=0,
+                FEINCMS3_SITES_HOST_RE_SAMPLE_INTERVAL=1,
+                FEINCMS3_SITES_HOST_RE_STRIKES=1,
+            ),
+        ):
+            with self.assertLogs("feincms3_sites.middleware", "ERROR") as logs:
+                response = self.client.get(
+                    "/site/", headers={"host": "www.example.org"}
+                )
+            self.assertEqual(
+                response.content.decode().split(), [str(site.pk), "www.example.org"]
+            )
+            self.assertIn(r"'example\\.org$' of the site example.org", logs.output[0])
+            self.assertEqual(received, [(Site, site.pk)])
+
+            # The regex is skipped now
+            response = self.client.get("/site/", headers={"host": "www.example.org"})
+            self.assertEqual(response.content.decode().split()[0], str(default.pk))
+
 
 @override_settings(
     MIDDLEWARE=[
@@ -530,6 +940,56 @@ class PortHandlingTest(TestCase):
         )
         self.assertEqual(response.status_code, 200)
 
+    @override_settings(
+        MIDDLEWARE=[
+            "feincms3_sites.middleware.site_middleware",
+            "feincms3_sites.middleware.redirect_to_site_middleware",
+        ]
+    )
+    def test_request_attributes(self):
+        with mock.patch(
+            "django.http.request.validate_host", wraps=validate_host
+        ) as validate:
+            response = self.client.get("/site/", headers={"host": "example.com:80"})
+        self.assertEqual(response.content.decode(), f"{self.test_site.pk} example.com")
+        self.assertEqual(validate.call_count, 1)
+
+    @override_settings(
+        MIDDLEWARE=[
+            "feincms3_sites.middleware.site_middleware",
+            "feincms3_sites.middleware.redirect_to_site_middleware",
+        ],
+        ALLOWED_HOSTS=["*"],
+        FEINCMS3_SITES_VALIDATE_HOSTS=True,
+    )
+    def test_validate_hosts(self):
+        site = Site.objects.create(
+            host="example.org", host_re=r"example\.org$", is_managed_re=False
+        )
+
+        with mock.patch(
+            "django.http.request.validate_host", wraps=validate_host
+        ) as validate:
+            response = self.client.get("/site/", headers={"host": "example.com:80"})
+        self.assertEqual(response.content.decode(), f"{self.test_site.pk} example.com")
+        self.assertEqual(validate.call_count, 0)
+
+        response = self.client.get("/site/", headers={"host": "www.example.org"})
+        self.assertRedirects(
+            response,
+            "http://example.org/site/",
+            status_code=301,
+            fetch_redirect_response=False,
+        )
+        response = self.client.get("/site/", headers={"host": "example.org."})
+        self.assertEqual(response.content.decode(), f"{site.pk} example.org")
+
+        # Hosts matched by no site do not fall back to the default site
+        for host in ["example.net", "example.com:8000", "exa_mple.org"]:
+            with self.subTest(host=host):
+                response = self.client.get("/site/", headers={"host": host})
+                self.assertEqual(response.status_code, 400)
+
     def test_site_for_host_strips_trailing_dot(self):
         self.test_site.is_default = False
         self.test_site.save()
@@ -602,6 +1062,25 @@ class CanonicalDomainTestCase(CanonicalDomainMiddlewareTest):
         self.assertEqual(response.status_code, 301)
         self.assertEqual(response["Location"], "https://example.com/")
 
+    def test_redirect_table(self):
+        response = self.client.get("/", headers={"host": "example.org"})
+        self.assertEqual(response["Location"], "http://example.com/")
+
+        with self.assertNumQueries(0):
+            response = self.client.get("/a/?b=c", headers={"host": "example.org"})
+        self.assertEqual(response.status_code, 301)
+        self.assertEqual(response["Location"], "http://example.com/a/?b=c")
+
+        # The secure variant is resolved separately
+        response = self.client.get("/", headers={"host": "example.org"}, secure=True)
+        self.assertEqual(response["Location"], "https://example.com/")
+
+        # Site changes invalidate the table
+        Site.objects.create(host="example.org")
+        self.assertEqual(
+            self.client.get("/de/", headers={"host": "example.org"}).status_code, 404
+        )
+
         self.assertContains(
             self.client.get("/de/", headers={"host": "example.com"}, secure=True),
             "home - testapp",
@@ -763,6 +1242,389 @@ class DefaultLanguageTest(TestCase):
         )
 
 
+class HostIndexTest(SimpleTestCase):
+    def test_analyze_host_re(self):
+        for host_re, result in [
+            (r"^example\.com$", ("exact", "example.com")),
+            (r"^Example\.com:8000$", ("exact", "example.com:8000")),
+            (
+                "^%s$" % re.escape("my-site.example.com"),
+                ("exact", "my-site.example.com"),
+            ),
+            (r"^([a-z0-9-]+\.)?example\.com$", ("suffix", ("com", "example"))),
+            (r"^(?:www\.)?example\.com$", ("suffix", ("com", "example"))),
+            (r"^(.+\.)?example\.com$", ("suffix", ("com", "example"))),
+            (r"example\.com$", ("suffix", ("com",))),
+            (r"\.example\.com$", ("suffix", ("com", "example"))),
+            (r"com$", ("suffix", ())),
+            (r"^example\.com", None),
+            (r"^example.com$", None),
+            (r"^(a|b)\.example\.com$", None),
+            (r"^[a-z]+\.example\.com$", None),
+            (r"^(foo\\.)?example\.com$", None),
+            (r"^exämple\.com$", None),
+            (r"^example\d\.com$", None),
+            (r"", None),
+        ]:
+            with self.subTest(host_re=host_re):
+                self.assertEqual(analyze_host_re(host_re), result)
+
+    def test_same_results(self):
+        """The index returns the same site as testing all regexes in order"""
+        sites = [
+            SimpleNamespace(pk=pk, host_re=host_re, is_default=is_default)
+            for pk, host_re, is_default in [
+                (1, r"^default\.com$", True),
+                (2, r"^example\.com$", False),
+                (3, r"^([a-z0-9-]+\.)?example\.com$", False),
+                (4, r"^(www\.)?example\.org$", False),
+                (5, r"example\.net$", False),
+                (6, r"^test[0-9]+\.example\.org$", False),
+                (7, r"^WWW\.EXAMPLE\.ORG$", False),
+                (8, r"\.ch$", False),
+                (9, r"^(.+\.)?sub\.example\.com$", False),
+                (10, r"^other-default\.com$", True),
+                (11, r"^exämple\.com$", False),
+            ]
+        ]
+        index = HostIndex(
+            tuple(
+                (re.compile(site.host_re, re.IGNORECASE), site)
+                for site in sorted(sites, key=lambda site: (-site.is_default, site.pk))
+            )
+        )
+        for host in [
+            "default.com",
+            "other-default.com",
+            "example.com",
+            "EXAMPLE.com",
+            "www.example.com",
+            "a.b.example.com",
+            "a.sub.example.com",
+            "sub.example.com",
+            "example.org",
+            "www.example.org",
+            "test1.example.org",
+            "testx.example.org",
+            "example.net",
+            "myexample.net",
+            "www.example.net",
+            "example.ch",
+            "exämple.com",
+            "EXÄMPLE.com",
+            "example.com\n",
+            "unknown",
+            "",
+        ]:
+            with self.subTest(host=host):
+                self.assertIs(
+                    index.site_for_host(host), site_for_host(host, sites=sites)
+                )
+
+    def test_quarantine(self):
+        default = SimpleNamespace(pk=1, is_default=True)
+        wildcard = SimpleNamespace(pk=2, is_default=False)
+        quarantined = []
+        index = HostIndex(
+            (
+                (re.compile(r"^example\.com$"), default),
+                (re.compile(r"example\.(com|org)$"), wildcard),
+            ),
+            budget=0,
+            sample_interval=2,
+            strikes=2,
+            on_quarantine=lambda site, elapsed: quarantined.append(site),
+        )
+
+        # Only every second lookup is timed
+        for _ in range(3):
+            self.assertIs(index.site_for_host("example.org"), wildcard)
+        self.assertEqual(index.quarantined, frozenset())
+        self.assertIs(index.site_for_host("example.org"), wildcard)
+        self.assertEqual(index.quarantined, {1})
+        self.assertEqual(quarantined, [wildcard])
+
+        # Quarantined regexes are skipped
+        self.assertIs(index.site_for_host("example.org"), default)
+        self.assertIs(index.site_for_host("example.com"), default)
+        self.assertEqual(quarantined, [wildcard])
+
+        # Fast samples reset the count of slow samples
+        index = HostIndex(
+            ((re.compile(r"example\.(com|org)$"), wildcard),),
+            budget=0,
+            sample_interval=1,
+            strikes=2,
+        )
+        index.site_for_host("example.org")
+        index.budget = 1
+        index.site_for_host("example.org")
+        index.budget = 0
+        index.site_for_host("example.org")
+        self.assertEqual(index.quarantined, frozenset())
+        index.site_for_host("example.org")
+        self.assertEqual(index.quarantined, {0})
+
+    def test_single_slow_sample(self):
+        wildcard = SimpleNamespace(pk=2, is_default=False)
+        index = HostIndex(
+            ((re.compile(r"example\.(com|org)$"), wildcard),),
+            budget=0.5,
+            sample_interval=1,
+            strikes=1,
+        )
+        # The first search is slow, the second one isn't
+        timings = itertools.chain([0, 1, 1], itertools.repeat(1))
+        with mock.patch("feincms3_sites.hosts.perf_counter", side_effect=timings):
+            self.assertIs(index.site_for_host("example.org"), wildcard)
+        self.assertEqual(index.quarantined, frozenset())
+
+
+class SiteAppsURLconfTest(SimpleTestCase):
+    def setUp(self):
+        _urlconfs.clear()
+        _evicted.clear()
+        clear_url_caches()
+
+    def apps(self, number):
+        return [(f"/blog-{number}/", "blog", f"blog-{number}", "en")]
+
+    @override_settings(FEINCMS3_SITES_MAX_URLCONFS=2)
+    def test_lru(self):
+        first = site_apps_urlconf(apps=self.apps(1))
+        second = site_apps_urlconf(apps=self.apps(2))
+        # Identical applications share their URLconf
+        self.assertEqual(site_apps_urlconf(apps=self.apps(1)), first)
+        self.assertEqual(list(_urlconfs), [second, first])
+
+        get_resolver(second).reverse_dict  # noqa: B018
+        self.assertEqual(_get_cached_resolver.cache_info().currsize, 1)
+
+        # Evicted URLconfs are removed in batches
+        third = site_apps_urlconf(apps=self.apps(3))
+        self.assertEqual(list(_urlconfs), [first, third])
+        self.assertIn(second, sys.modules)
+        self.assertEqual(_get_cached_resolver.cache_info().currsize, 1)
+
+        fourth = site_apps_urlconf(apps=self.apps(4))
+        self.assertEqual(list(_urlconfs), [third, fourth])
+        self.assertNotIn(first, sys.modules)
+        self.assertNotIn(second, sys.modules)
+        self.assertIn(third, sys.modules)
+        self.assertEqual(_get_cached_resolver.cache_info().currsize, 0)
+
+        # Evicted URLconfs are generated again
+        self.assertEqual(site_apps_urlconf(apps=self.apps(2)), second)
+        self.assertIn(second, sys.modules)
+        self.assertEqual(
+            reverse("apps-en:blog-2:article-list", urlconf=second), "/blog-2/"
+        )
+
+        self.assertEqual(site_apps_urlconf(apps=[]), settings.ROOT_URLCONF)
+        self.assertEqual(list(_urlconfs), [fourth, second])
+
+    @override_settings(FEINCMS3_SITES_MAX_URLCONFS=1)
+    def test_in_use(self):
+        first = site_apps_urlconf(apps=self.apps(1))
+        set_urlconf(first)
+        try:
+            second = site_apps_urlconf(apps=self.apps(2))
+            # The URLconf of the current thread isn't removed
+            self.assertIn(first, sys.modules)
+            self.assertEqual(reverse("apps-en:blog-1:article-list"), "/blog-1/")
+        finally:
+            set_urlconf(None)
+
+        site_apps_urlconf(apps=self.apps(3))
+        self.assertNotIn(first, sys.modules)
+        self.assertNotIn(second, sys.modules)
+
+    @override_settings(FEINCMS3_SITES_MAX_URLCONFS=1)
+    def test_urlconf_in_use(self):
+        first = site_apps_urlconf(apps=self.apps(1))
+
+        def generate():
+            return site_apps_urlconf(apps=self.apps(1))
+
+        with _urlconf_in_use(first, generate) as urlconf:
+            self.assertEqual(urlconf, first)
+            site_apps_urlconf(apps=self.apps(2))
+            site_apps_urlconf(apps=self.apps(3))
+            self.assertIn(first, sys.modules)
+            self.assertEqual(
+                reverse("apps-en:blog-1:article-list", urlconf=first), "/blog-1/"
+            )
+
+        site_apps_urlconf(apps=self.apps(4))
+        self.assertNotIn(first, sys.modules)
+
+        # Removed URLconfs are generated again and remembered
+        with _urlconf_in_use(first, generate) as urlconf:
+            self.assertEqual(urlconf, first)
+            self.assertIn(first, sys.modules)
+            self.assertEqual(list(_urlconfs), [first])
+
+    @override_settings(FEINCMS3_SITES_MAX_URLCONFS=None)
+    def test_unbounded(self):
+        site_apps_urlconf(apps=[("/blog/", "blog", "blog", "en")])
+        self.assertEqual(list(_urlconfs), [])
+
+
+class HostChecksTest(SimpleTestCase):
+    def test_host_re_time(self):
+        self.assertLess(host_re_time(r"^example\.com$", budget=0.01), 0.01)
+        self.assertLess(host_re_time(r"example\.com$", budget=0.01), 0.01)
+        self.assertGreater(host_re_time(r"^(\w+)*$", budget=0.001), 0.001)
+        self.assertGreater(host_re_time(r"^([a-z.-]+)+\.com$", budget=0.001), 0.001)
+
+        # A single slow search doesn't fail the regex
+        timings = itertools.chain([0, 1], itertools.repeat(1))
+        with mock.patch("feincms3_sites.hosts.perf_counter", side_effect=timings):
+            self.assertEqual(host_re_time(r"^example\.com$", budget=0.01), 0)
+
+    def test_shadowed_sites(self):
+        def site(pk, host, host_re, *, is_default=False):
+            return SimpleNamespace(
+                pk=pk, host=host, host_re=host_re, is_default=is_default
+            )
+
+        default = site(3, "example.com", r"^example\.com$", is_default=True)
+        www = site(1, "www.example.org", r"^www\.example\.org$")
+        wildcard = site(2, "example.org", r"example\.org$")
+        new = site(None, "example.com", r"^example\.(net|com)$")
+
+        self.assertEqual(list(shadowed_sites([default, wildcard, www])), [])
+        # The default site is tested first
+        self.assertEqual(
+            list(shadowed_sites([default, wildcard, www, new])),
+            [(new, default)],
+        )
+
+        new.pk = 0
+        new.host = "example.net"
+        new.host_re = r"example\.(net|org)$"
+        self.assertEqual(
+            list(shadowed_sites([default, wildcard, www, new])),
+            [(www, new), (wildcard, new)],
+        )
+        self.assertEqual(
+            list(shadowed_sites([default, wildcard, www, new], only=www)),
+            [(www, new)],
+        )
+        self.assertEqual(
+            list(shadowed_sites([default, wildcard, www, new], only=default)), []
+        )
+
+
+class ProfileHostResolutionTest(TestCase):
+    def setUp(self):
+        self.default = Site.objects.create(host="example.com", is_default=True)
+        self.overlap = Site.objects.create(host="www.example.org")
+        self.other = Site.objects.create(
+            host="example.org", host_re=r"example\.org$", is_managed_re=False
+        )
+
+    def test_command(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".log") as f:
+            f.write(
+                "example.com - - [01/Jan/2026] GET /\n"
+                "example.com:443 - - [01/Jan/2026] GET /\n"
+                "www.example.org - - [01/Jan/2026] GET /\n"
+                "example.org - - [01/Jan/2026] GET /\n"
+                "unknown.com - - [01/Jan/2026] GET /\n"
+                "\n"
+            )
+            f.flush()
+
+            stdout = io.StringIO()
+            call_command("profile_host_resolution", f.name, stdout=stdout)
+
+        output = stdout.getvalue()
+        self.assertIn("Resolved 5 hosts (4 distinct)", output)
+        self.assertIn(f"         3  example.com ({self.default.pk})", output)
+        self.assertIn(f"         1  example.org ({self.other.pk})", output)
+        self.assertIn(f"         1  www.example.org ({self.overlap.pk})", output)
+        self.assertIn("         1  unknown.com", output)
+        self.assertIn(
+            f"  www.example.org: www.example.org ({self.overlap.pk}),"
+            f" example.org ({self.other.pk})",
+            output,
+        )
+        self.assertIn(r"example\.org$", output)
+
+    def test_regex(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".log") as f:
+            f.write('1.2.3.4 - - "GET /" 200 host="example.org"\n')
+            f.flush()
+
+            stdout = io.StringIO()
+            call_command(
+                "profile_host_resolution",
+                f.name,
+                regex=r'host="(?P<host>[^"]+)"',
+                stdout=stdout,
+            )
+
+        self.assertIn(f"         1  example.org ({self.other.pk})", stdout.getvalue())
+
+
+class ProfileMemoryTest(TestCase):
+    def test_command(self):
+        stdout = io.StringIO()
+        call_command(
+            "profile_memory",
+            sites=3,
+            requests=2,
+            app="blog:article-list",
+            stdout=stdout,
+        )
+
+        output = stdout.getvalue()
+        self.assertIn("Sites: 3, requests per site: 2", output)
+        self.assertIn("KiB per site", output)
+        self.assertIn("Growth during 6 requests:", output)
+        self.assertIn("Top allocation sites:", output)
+        # Everything has been rolled back
+        self.assertEqual(Site.objects.count(), 0)
+        self.assertEqual(Page.objects.count(), 0)
+
+    def test_errors(self):
+        with self.assertRaisesRegex(CommandError, "has to be of the form"):
+            call_command("profile_memory", app="blog")
+        with self.assertRaisesRegex(CommandError, "more than the maximum of 0 bytes"):
+            call_command(
+                "profile_memory",
+                sites=2,
+                requests=1,
+                max_per_site=0,
+                stdout=io.StringIO(),
+            )
+        self.assertEqual(Site.objects.count(), 0)
+
+
+class ContextProcessorTest(TestCase):
+    def test_site(self):
+        site = Site.objects.create(host="example.com")
+        other = Site.objects.create(host="example.org")
+        request = RequestFactory().get("/", headers={"host": "example.com"})
+
+        def view(request):
+            with self.assertNumQueries(0):
+                return context_processors.site(request)
+
+        self.assertEqual(site_middleware(view)(request), {"current_site": site})
+        self.assertEqual(request.site, site)
+        self.assertEqual(
+            {pk: record.instance for pk, record in request.sites.items()},
+            {site.pk: site, other.pk: other},
+        )
+
+        request = RequestFactory().get("/")
+        self.assertEqual(context_processors.site(request), {"current_site": None})
+        with set_current_site(other):
+            self.assertEqual(context_processors.site(request), {"current_site": other})
+
+
 class SiteTest(TestCase):
     def test_language_codes_validation(self):
         validate_language_codes("")
@@ -874,7 +1736,624 @@ class SiteModelTest(TestCase):
     @isolate_apps("testapp")
     @override_settings(FEINCMS3_SITES_SITE_GET_HOST=lambda site: "return value")
     def test_custom_get_host(self):
+        # Preparing the model replaces AbstractSite.get_host, restore it
+        self.addCleanup(setattr, AbstractSite, "get_host", AbstractSite.get_host)
+
         class MySite(AbstractSite):
             pass
 
         self.assertEqual(MySite().get_host(), "return value")
+
+    def test_shadowed_hosts(self):
+        Site.objects.create(host="example.com", is_default=True)
+        wildcard = Site.objects.create(
+            host="example.org", host_re=r"example\.org$", is_managed_re=False
+        )
+
+        # The host of the new site would still resolve to the wildcard site
+        with self.assertRaisesRegex(ValidationError, "already matched by the site"):
+            Site.objects.create(host="www.example.org")
+
+        # The changed regex would take over the host of a newer site
+        Site.objects.create(host="example.net")
+        wildcard.host_re = r"example\.(org|net)$"
+        with self.assertRaisesRegex(ValidationError, "would not be reachable"):
+            wildcard.save()
+        wildcard.refresh_from_db()
+
+        # Inactive sites do not take part in resolving hosts
+        Site.objects.create(host="www.example.org", is_active=False)
+        wildcard.is_active = False
+        wildcard.save()
+        Site.objects.create(host="www.example.org")
+
+    def test_slow_host_re(self):
+        with (
+            override_settings(FEINCMS3_SITES_HOST_RE_BUDGET=0.001),
+            self.assertRaisesRegex(ValidationError, "regular expression is too slow"),
+        ):
+            Site.objects.create(host="aaa", host_re=r"^(a+)+$", is_managed_re=False)
+
+        site = Site.objects.create(
+            host="example.com",
+            host_re=r"^([a-z0-9-]+\.)*example\.com$",
+            is_managed_re=False,
+        )
+        self.assertEqual(site.host_re, r"^([a-z0-9-]+\.)*example\.com$")
+
+    @override_settings(FEINCMS3_SITES_HOST_RE_BUDGET=0.001)
+    def test_check_sites(self):
+        Site.objects.create(host="example.com", is_default=True)
+        site = Site.objects.create(host="aaa")
+        other = Site.objects.create(host="example.org")
+        self.assertEqual(check_sites(databases=["default"]), [])
+
+        # Bypass the validation
+        Site.objects.filter(pk=site.pk).update(host_re=r"^(a+)+$|example\.org")
+        self.assertEqual(check_sites(), [])
+        self.assertEqual(
+            [(error.id, error.obj) for error in check_sites(databases=["default"])],
+            [("feincms3_sites.E002", site), ("feincms3_sites.W001", other)],
+        )
+
+
+@override_settings(
+    DATABASE_ROUTERS=["feincms3_sites.routers.SiteRouter"],
+    FEINCMS3_SITES_DATABASES={"tenant.com": "replica"},
+)
+class SiteRouterTest(TestCase):
+    databases = {"default", "replica"}
+
+    def setUp(self):
+        self.default = Site.objects.create(host="example.com", is_default=True)
+        self.tenant = Site.objects.create(host="tenant.com")
+        for site in [self.default, self.tenant]:
+            Page.objects.create(
+                title="home",
+                slug="home",
+                path="/en/",
+                static_path=True,
+                language_code="en",
+                is_active=True,
+                site=site,
+            )
+
+        # The replica only contains the data of the tenant
+        Site.objects.using("replica").bulk_create([self.tenant])
+        Page.objects.using("replica").bulk_create(
+            [
+                Page(
+                    pk=page.pk,
+                    title="replica",
+                    slug=page.slug,
+                    path=page.path,
+                    position=page.position,
+                    language_code=page.language_code,
+                    is_active=True,
+                    site_id=page.site_id,
+                )
+                for page in Page.objects.filter(site=self.tenant)
+            ]
+        )
+
+    def test_active(self):
+        self.assertEqual(database_for_site(self.tenant), "replica")
+        self.assertIsNone(database_for_site(self.default))
+        self.assertIsNone(database_for_site(None))
+
+        self.assertEqual(
+            [page.title for page in Page.objects.active(site=self.tenant)],
+            ["replica"],
+        )
+        self.assertEqual(
+            [page.title for page in Page.objects.active(site=self.default)],
+            ["home"],
+        )
+        # Explicitly selected databases are respected
+        self.assertEqual(
+            [
+                page.title
+                for page in Page.objects.using("default").active(site=self.tenant)
+            ],
+            ["home"],
+        )
+
+    @override_settings(DATABASE_ROUTERS=[])
+    def test_active_without_router(self):
+        page = Page.objects.active(site=self.tenant).get()
+        self.assertEqual(page.title, "home")
+        page.title = "edited"
+        page.save()
+        self.assertEqual(Page.objects.using("default").get(pk=page.pk).title, "edited")
+        self.assertEqual(Page.objects.using("replica").get(pk=page.pk).title, "replica")
+
+    def test_router(self):
+        with set_current_site(self.tenant):
+            self.assertEqual([page.title for page in Page.objects.all()], ["replica"])
+            self.assertEqual(Page.objects.all().db, "replica")
+            # Models without site foreign key and writes are not routed
+            self.assertEqual(Site.objects.all().db, "default")
+            self.assertEqual(User.objects.all().db, "default")
+            self.assertEqual(router.db_for_write(Page), "default")
+
+        with set_current_site(self.default):
+            self.assertEqual(Page.objects.all().db, "default")
+        self.assertEqual(Page.objects.all().db, "default")
+
+        with set_current_site(self.tenant):
+            page = Page.objects.get()
+        self.assertEqual(page._state.db, "replica")
+        other = Page.objects.get(site=self.default)
+        self.assertTrue(SiteRouter().allow_relation(page, other))
+        other._state.db = "unknown"
+        self.assertIsNone(SiteRouter().allow_relation(page, other))
+
+    def test_save_routed_instance(self):
+        with set_current_site(self.tenant):
+            page = Page.objects.get()
+            self.assertEqual(page._state.db, "replica")
+            self.assertEqual(router.db_for_write(Page, instance=page), "default")
+            page.title = "edited"
+            page.save()
+
+        self.assertEqual(Page.objects.using("default").get(pk=page.pk).title, "edited")
+        self.assertEqual(Page.objects.using("replica").get(pk=page.pk).title, "replica")
+
+
+@override_settings(
+    MIDDLEWARE=[
+        "feincms3_sites.middleware.site_middleware",
+        "feincms3_sites.ratelimit.site_rate_limit_middleware",
+    ],
+    FEINCMS3_SITES_RATE_LIMITS={"example.com": (1, 2), "*": (100, 100)},
+)
+class RateLimitTest(TestCase):
+    def setUp(self):
+        _buckets.clear()
+        caches["default"].clear()
+        self.site = Site.objects.create(host="example.com", is_default=True)
+        self.other = Site.objects.create(host="example.org")
+
+    def get(self, host):
+        return self.client.get("/site/", headers={"host": host})
+
+    def test_local(self):
+        self.assertEqual(self.get("example.com").status_code, 200)
+        self.assertEqual(self.get("example.com").status_code, 200)
+        response = self.get("example.com")
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response["Retry-After"], "1")
+        self.assertEqual(self.get("example.org").status_code, 200)
+
+        # Refill a token
+        for bucket in _buckets.values():
+            bucket.updated -= 1
+        self.assertEqual(self.get("example.com").status_code, 200)
+        self.assertEqual(self.get("example.com").status_code, 429)
+
+    @override_settings(FEINCMS3_SITES_RATE_LIMIT_SHARED=True)
+    def test_shared(self):
+        with mock.patch("time.time", return_value=1000.5):
+            self.assertEqual(self.get("example.com").status_code, 200)
+            self.assertEqual(self.get("example.com").status_code, 200)
+            response = self.get("example.com")
+            self.assertEqual(response.status_code, 429)
+            self.assertEqual(response["Retry-After"], "2")
+            self.assertEqual(self.get("example.org").status_code, 200)
+        self.assertEqual(_buckets, {})
+
+        # The next window
+        with mock.patch("time.time", return_value=1002.5):
+            self.assertEqual(self.get("example.com").status_code, 200)
+
+    @override_settings(FEINCMS3_SITES_RATE_LIMITS={})
+    def test_unlimited(self):
+        for _ in range(5):
+            self.assertEqual(self.get("example.com").status_code, 200)
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=2, capacity=1)
+        self.assertEqual(bucket.take(), 0)
+        self.assertAlmostEqual(bucket.take(), 0.5, places=2)
+        bucket.updated -= 0.5
+        self.assertEqual(bucket.take(), 0)
+
+
+@override_settings(
+    MIDDLEWARE=[
+        "feincms3_sites.middleware.site_middleware",
+        "feincms3_sites.metrics.site_metrics_middleware",
+    ],
+    FEINCMS3_SITES_METRICS_INTERVAL=3600,
+)
+class MetricsTest(TestCase):
+    def setUp(self):
+        self.flushed = []
+        collector.flush()
+        self.site = Site.objects.create(host="example.com", is_default=True)
+        self.other = Site.objects.create(host="example.org")
+
+    def sink(self, metrics, *, duration):
+        self.flushed.append(metrics)
+
+    def test_collect(self):
+        self.client.get("/site/", headers={"host": "example.com"})
+        self.client.get("/site/", headers={"host": "example.com"})
+        self.client.get("/sitemap.xml?p=0", headers={"host": "example.com"})
+        self.client.get("/site/", headers={"host": "example.org"})
+
+        with override_settings(FEINCMS3_SITES_METRICS_SINK=self.sink):
+            collector.flush()
+            collector.flush()
+
+        self.assertEqual(len(self.flushed), 1)
+        metrics = self.flushed[0]
+        self.assertEqual(set(metrics), {self.site.pk, self.other.pk})
+        self.assertEqual(metrics[self.site.pk]["requests"], 3)
+        self.assertEqual(metrics[self.site.pk]["status_codes"], {200: 2, 404: 1})
+        self.assertEqual(sum(metrics[self.site.pk]["latency_buckets"].values()), 3)
+        self.assertEqual(
+            list(metrics[self.other.pk]["latency_buckets"]), list(LATENCY_BUCKETS)
+        )
+        self.assertGreater(metrics[self.other.pk]["latency_sum"], 0)
+
+    def test_interval(self):
+        with override_settings(
+            FEINCMS3_SITES_METRICS_SINK=self.sink, FEINCMS3_SITES_METRICS_INTERVAL=0
+        ):
+            self.client.get("/site/", headers={"host": "example.com"})
+            self.client.get("/site/", headers={"host": "example.org"})
+        self.assertEqual(
+            [list(metrics) for metrics in self.flushed],
+            [[self.site.pk], [self.other.pk]],
+        )
+
+    @override_settings(
+        MIDDLEWARE=[
+            "feincms3_sites.middleware.site_middleware",
+            "feincms3_sites.metrics.site_metrics_middleware",
+            "feincms3_sites.middleware.redirect_to_site_middleware",
+        ]
+    )
+    def test_remembered_redirects(self):
+        # Remembered redirects are still recorded
+        for _ in range(2):
+            response = self.client.get("/site/", headers={"host": "www.example.com"})
+            self.assertEqual(response["Location"], "http://example.com/site/")
+
+        with override_settings(FEINCMS3_SITES_METRICS_SINK=self.sink):
+            collector.flush()
+        self.assertEqual(self.flushed[0][self.site.pk]["status_codes"], {301: 2})
+
+    def test_failing_sink(self):
+        def sink(metrics, *, duration):
+            raise RuntimeError("sink")
+
+        with (
+            override_settings(
+                FEINCMS3_SITES_METRICS_SINK=sink, FEINCMS3_SITES_METRICS_INTERVAL=0
+            ),
+            self.assertLogs("feincms3_sites.metrics", "ERROR"),
+        ):
+            response = self.client.get("/site/", headers={"host": "example.com"})
+        self.assertEqual(response.status_code, 200)
+
+    def test_log_sink(self):
+        self.client.get("/site/", headers={"host": "example.com"})
+        with self.assertLogs("feincms3_sites.metrics", "INFO") as logs:
+            collector.flush()
+        line = json.loads(logs.records[0].getMessage())
+        self.assertEqual(line["site"], self.site.pk)
+        self.assertEqual(line["requests"], 1)
+        self.assertEqual(line["status_codes"], {"200": 1})
+
+
+@override_settings(
+    MIDDLEWARE=["feincms3_sites.middleware.site_middleware"],
+    FEINCMS3_SITES_READ_DATABASE="replica",
+)
+class ReadDatabaseTest(TestCase):
+    databases = {"default", "replica"}
+
+    def setUp(self):
+        self.site = Site.objects.create(host="example.com", is_default=True)
+        # The replica lags behind
+        self.replica = Site(
+            pk=self.site.pk + 1, host="replica.com", host_re=r"^replica\.com$"
+        )
+        Site.objects.using("replica").bulk_create([self.replica])
+
+    def test_site_middleware(self):
+        invalidate_sites()
+        # Snapshots of new versions are loaded from the primary database
+        response = self.client.get("/site/", headers={"host": "replica.com"})
+        self.assertEqual(response.content.decode(), f"{self.site.pk} replica.com")
+
+        _sites_state.snapshot.expires = 0
+        response = self.client.get("/site/", headers={"host": "replica.com"})
+        self.assertEqual(response.content.decode(), f"{self.replica.pk} replica.com")
+
+        # Instances are saved to the primary database
+        sites = contextvars.Context().run(load_sites)
+        self.assertEqual(list(sites), [self.replica.pk])
+        self.assertEqual(sites[self.replica.pk].instance._state.db, "default")
+
+    def test_primary_after_write(self):
+        # Site.objects.create() has written to the primary database
+        load_sites()
+        _sites_state.snapshot.expires = 0
+        self.assertEqual(list(load_sites()), [self.site.pk])
+
+        # The read database is used again after a while
+        with override_settings(FEINCMS3_SITES_READ_DATABASE_DELAY=0):
+            load_sites()
+            _sites_state.snapshot.expires = 0
+            self.assertEqual(list(load_sites()), [self.replica.pk])
+
+    def test_reverse_site_app(self):
+        _del_reverse_site_cache()
+        context = contextvars.Context()
+        with (
+            self.assertNumQueries(1, using="replica"),
+            self.assertRaises(NoReverseMatch),
+        ):
+            context.run(reverse_site_app, "blog", "article-detail", site=self.site)
+
+        with (
+            self.assertNumQueries(1, using="default"),
+            self.assertRaises(NoReverseMatch),
+        ):
+            reverse_site_app("blog", "article-detail", site=self.site.pk + 1)
+
+
+@override_settings(
+    MIDDLEWARE=[
+        *settings.MIDDLEWARE_BASE,
+        "feincms3_sites.middleware.site_middleware",
+        "feincms3.applications.apps_middleware",
+    ]
+)
+class SitemapTest(TestCase):
+    def setUp(self):
+        self.test_site = Site.objects.create(host="testserver", is_default=True)
+        home = Page.objects.create(
+            title="home",
+            slug="home",
+            path="/en/",
+            static_path=True,
+            language_code="en",
+            is_active=True,
+            site=self.test_site,
+        )
+        Page.objects.create(
+            title="blog",
+            slug="blog",
+            language_code="en",
+            is_active=True,
+            page_type="blog",
+            parent=home,
+        )
+        Page.objects.create(
+            title="other",
+            slug="other",
+            path="/en/",
+            static_path=True,
+            language_code="en",
+            is_active=True,
+            site=Site.objects.create(host="testserver2"),
+        )
+        self.article = Article.objects.create(
+            title="article", category="blog", site=self.test_site
+        )
+
+        _del_apps_urlconf_cache()
+        _del_reverse_site_cache()
+
+    def test_sitemap(self):
+        response = self.client.get("/sitemap.xml")
+        self.assertEqual(response["Content-Type"], "application/xml")
+        content = b"".join(response.streaming_content).decode()
+        self.assertEqual(
+            content.count("<loc>"),
+            3,
+        )
+        self.assertIn("<loc>http://testserver/en/</loc>", content)
+        self.assertIn("<loc>http://testserver/en/blog/</loc>", content)
+        self.assertIn(
+            f"<loc>http://testserver/en/blog/{self.article.pk}/</loc>", content
+        )
+
+        response = self.client.get("/sitemap.xml", headers={"host": "testserver2"})
+        content = b"".join(response.streaming_content).decode()
+        self.assertEqual(content.count("<loc>"), 1)
+        self.assertIn("<loc>http://testserver2/en/</loc>", content)
+
+    def test_sitemap_index(self):
+        response = self.client.get("/sitemap-small.xml")
+        content = b"".join(response.streaming_content).decode()
+        self.assertIn("<sitemapindex", content)
+        self.assertIn(
+            "<loc>http://testserver/sitemap-small.xml?p=1</loc>"
+            "</sitemap>\n<sitemap><loc>http://testserver/sitemap-small.xml?p=2</loc>",
+            content,
+        )
+        self.assertNotIn("p=3", content)
+
+        first = b"".join(
+            self.client.get("/sitemap-small.xml?p=1").streaming_content
+        ).decode()
+        second = b"".join(
+            self.client.get("/sitemap-small.xml?p=2").streaming_content
+        ).decode()
+        self.assertEqual(first.count("<loc>"), 2)
+        self.assertEqual(second.count("<loc>"), 1)
+        self.assertIn(f"/en/blog/{self.article.pk}/</loc>", second)
+
+        self.assertEqual(self.client.get("/sitemap-small.xml?p=0").status_code, 404)
+        self.assertEqual(self.client.get("/sitemap-small.xml?p=3").status_code, 404)
+
+    def test_stable_ordering(self):
+        self.assertEqual(
+            _stable(Page.objects.active()).query.order_by, ("tree_ordering", "pk")
+        )
+        self.assertEqual(_stable(Article.objects.all()).query.order_by, ("-pk", "pk"))
+        self.assertEqual(
+            _stable(Article.objects.order_by("title")).query.order_by,
+            ("title", "pk"),
+        )
+        self.assertEqual(_stable([self.article]), [self.article])
+        self.assertEqual(self.client.get("/sitemap-small.xml?p=x").status_code, 404)
+
+
+@override_settings(
+    MIDDLEWARE=[
+        "django.middleware.common.CommonMiddleware",
+        "feincms3_sites.middleware.site_middleware",
+        "feincms3_sites.middleware.default_language_middleware",
+        "feincms3_sites.cache.site_cache_middleware",
+    ]
+)
+class SiteCacheMiddlewareTest(TestCase):
+    def setUp(self):
+        caches["default"].clear()
+        self.site = Site.objects.create(
+            host="example.com", host_re=r"example\.(com|org)$", is_managed_re=False
+        )
+        self.other = Site.objects.create(host="example.net", default_language="de")
+
+    def get(self, path, **headers):
+        return self.client.get(path, headers=headers).content.decode()
+
+    def test_cache(self):
+        first = self.get("/counter/", host="example.com")
+        self.assertTrue(first.endswith(" en"))
+        # Aliases share cache entries
+        self.assertEqual(self.get("/counter/", host="example.com"), first)
+        self.assertEqual(self.get("/counter/", host="www.example.org"), first)
+
+        # The query string is a part of the key
+        self.assertNotEqual(self.get("/counter/?a=b", host="example.com"), first)
+
+        # Languages are a part of the key
+        german = self.get("/counter/", host="example.com", accept_language="de")
+        self.assertTrue(german.endswith(" de"))
+        self.assertEqual(
+            self.get("/counter/", host="example.org", accept_language="de"), german
+        )
+
+        # Sites do not share entries
+        other = self.get("/counter/", host="example.net")
+        self.assertNotEqual(other, german)
+        self.assertEqual(self.get("/counter/", host="example.net"), other)
+
+        invalidate_site(self.site)
+        self.assertNotEqual(self.get("/counter/", host="example.com"), first)
+        self.assertEqual(self.get("/counter/", host="example.net"), other)
+
+        # Only GET and HEAD requests are cached
+        response = self.client.post("/counter/", headers={"host": "example.net"})
+        self.assertNotEqual(response.content.decode(), other)
+
+    def test_not_cacheable(self):
+        request = RequestFactory().get("/", headers={"cookie": "a=b"})
+
+        response = HttpResponse()
+        self.assertEqual(_cache_timeout(request, response), 600)
+        response["Cache-Control"] = "max-age=30"
+        self.assertEqual(_cache_timeout(request, response), 30)
+        response["Cache-Control"] = "max-age=0"
+        self.assertIsNone(_cache_timeout(request, response))
+
+        response = HttpResponse()
+        response["Vary"] = "Accept-Language, Cookie"
+        self.assertIsNone(_cache_timeout(request, response))
+        self.assertEqual(_cache_timeout(RequestFactory().get("/"), response), 600)
+        response["Vary"] = "Accept-Encoding"
+        self.assertIsNone(_cache_timeout(request, response))
+
+        response = HttpResponse()
+        response.set_cookie("a", "b")
+        self.assertIsNone(_cache_timeout(request, response))
+
+        response = HttpResponse()
+        response["Cache-Control"] = "private"
+        self.assertIsNone(_cache_timeout(request, response))
+
+        self.assertIsNone(_cache_timeout(request, HttpResponse(status=404)))
+
+    def test_generation(self):
+        generation = site_generation(self.site)
+        self.assertEqual(site_generation(self.site.pk), generation)
+        invalidate_site(self.site.pk)
+        self.assertEqual(site_generation(self.site), generation + 1)
+
+        caches["default"].clear()
+        invalidate_site(self.site)
+        self.assertIsNotNone(site_generation(self.site))
+
+    def test_site_cache_key(self):
+        with self.assertRaisesRegex(ImproperlyConfigured, "Current site unknown."):
+            site_cache_key("key")
+
+        with set_current_site(self.site):
+            key = site_cache_key("key")
+        self.assertEqual(site_cache_key("key", site=self.site.pk), key)
+        self.assertNotEqual(site_cache_key("key", site=self.other), key)
+        cache = caches["default"]
+        cache.set(key, "value")
+
+        page = Page.objects.create(
+            title="home",
+            slug="home",
+            path="/en/",
+            static_path=True,
+            site=self.other,
+        )
+        self.assertEqual(site_cache_key("key", site=self.site), key)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            page.site = self.site
+            page.save()
+        self.assertNotEqual(site_cache_key("key", site=self.site), key)
+        self.assertEqual(cache.get(key), "value")
+        self.assertIsNone(cache.get(site_cache_key("key", site=self.site)))
+
+        key = site_cache_key("key", site=self.site)
+        with self.captureOnCommitCallbacks(execute=True):
+            page.delete()
+        self.assertNotEqual(site_cache_key("key", site=self.site), key)
+
+        key = site_cache_key("key", site=self.site)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.site.save()
+        self.assertNotEqual(site_cache_key("key", site=self.site), key)
+
+    @override_settings(
+        MIDDLEWARE=[
+            "feincms3_sites.middleware.site_middleware",
+            "feincms3_sites.cache.site_cache_middleware",
+            "django.contrib.sessions.middleware.SessionMiddleware",
+        ]
+    )
+    def test_vary_cookie(self):
+        anonymous = self.get("/session-counter/", host="example.com")
+        self.assertTrue(anonymous.endswith(" anonymous"))
+        self.assertEqual(self.get("/session-counter/", host="example.com"), anonymous)
+
+        session = self.client.session
+        session["name"] = "visitor"
+        session.save()
+        self.client.cookies[settings.SESSION_COOKIE_NAME] = session.session_key
+
+        # The entry cached for requests without cookies isn't served
+        visitor = self.get("/session-counter/", host="example.com")
+        self.assertTrue(visitor.endswith(" visitor"))
+        self.assertNotEqual(self.get("/session-counter/", host="example.com"), visitor)
+
+        self.client.cookies.clear()
+        self.assertEqual(self.get("/session-counter/", host="example.com"), anonymous)
+
+    @override_settings(MIDDLEWARE=["feincms3_sites.cache.site_cache_middleware"])
+    def test_improperly_configured(self):
+        with self.assertRaisesRegex(ImproperlyConfigured, "Current site unknown."):
+            self.client.get("/counter/")
@@ -1,8 +1,35 @@
+from itertools import count
+
 from django.conf.urls.i18n import i18n_patterns
 from django.contrib import admin
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from django.shortcuts import render
 from django.urls import path
+from django.utils.translation import get_language
+
+from feincms3_sites.middleware import current_site
+from feincms3_sites.sitemaps import sitemap
+from testapp.models import Article, Page
+
+
+sitemap_sections = [
+    lambda site: Page.objects.active(site=site),
+    lambda site: Article.objects.filter(site=site),
+]
+
+counter = count()
+
+
+def stream(request):
+    def content():
+        for _ in range(3):
+            yield f"{current_site()}\n"
+
+    async def acontent():
+        for _ in range(3):
+            yield f"{current_site()}\n"
+
+    return StreamingHttpResponse(acontent() if "async" in request.GET else content())
 
 
 urlpatterns = i18n_patterns(
@@ -10,4 +37,21 @@ urlpatterns = i18n_patterns(
 ) + [
     path("admin/", admin.site.urls),
     path("404/", lambda request: render(request, "404.html")),
+    path("sitemap.xml", sitemap, {"sections": sitemap_sections}),
+    path(
+        "counter/",
+        lambda request: HttpResponse(f"{next(counter)} {get_language()}"),
+    ),
+    path(
+        "session-counter/",
+        lambda request: HttpResponse(
+            f"{next(counter)} {request.session.get('name', 'anonymous')}"
+        ),
+    ),
+    path(
+        "site/",
+        lambda request: HttpResponse(f"{request.site.pk} {request.normalized_host}"),
+    ),
+    path("sitemap-small.xml", sitemap, {"sections": sitemap_sections, "limit": 2}),
+    path("stream/", stream),
 ]